@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+from time import perf_counter
+
+import click
+import numpy as np
+from sklearn.cluster import KMeans
+from tqdm import tqdm
+
+from src.features.build_features import search_clustering
+
+
+def synthetic_tags(n_games=1000, n_tags=80, n_groups=5, seed=0):
+    """One-hot tag matrix in which every game mostly draws its tags from one of n_groups"""
+    rng = np.random.RandomState(seed)
+    groups = rng.randint(n_groups, size=n_games)
+    preference = rng.uniform(size=(n_groups, n_tags)) ** 4
+    probabilities = preference[groups] / preference[groups].sum(axis=1, keepdims=True) * 4
+    return (rng.uniform(size=(n_games, n_tags)) < probabilities).astype(float)
+
+
+def legacy_search(data, n_clusters, imax, cluster_max):
+    """The serial restart loop of FeatureGenerator.do_clustering before search_clustering"""
+    for i in tqdm(range(imax)):
+        km = KMeans(n_clusters=n_clusters, init='k-means++', max_iter=1000, n_init=1).fit(data)
+        clusters = list(km.predict(data))
+        biggest_cluster = max([tupl[1] for tupl in Counter(clusters).items()])
+        if biggest_cluster < cluster_max:
+            break
+    return km
+
+
+@click.command()
+@click.option('--attempts', default=200, help='Number of KMeans fits to time.')
+@click.option('--n-jobs', default=None, type=int, help='Processes for search_clustering.')
+def main(attempts, n_jobs):
+    """ Times a fixed number of KMeans restarts, the serial loop versus search_clustering.
+    """
+    data = synthetic_tags()
+    # cluster_max=0 can never be met, so both searches run all attempts
+    t0 = perf_counter()
+    legacy_search(data, 5, attempts, cluster_max=0)
+    serial = perf_counter() - t0
+    t0 = perf_counter()
+    search_clustering(data, 5, imax=attempts, cluster_max=0, n_jobs=n_jobs, random_state=0)
+    parallel = perf_counter() - t0
+    km_a, _ = search_clustering(data, 5, imax=attempts, cluster_max=300, n_jobs=n_jobs,
+                                random_state=0)
+    km_b, _ = search_clustering(data, 5, imax=attempts, cluster_max=300, n_jobs=n_jobs,
+                                random_state=0)
+    print('{:<25} {:>9.2f} s'.format('serial loop', serial))
+    print('{:<25} {:>9.2f} s'.format('search_clustering', parallel))
+    print('reproducible for a seed: {}'.format(np.allclose(km_a.cluster_centers_,
+                                                           km_b.cluster_centers_)))
+
+
+if __name__ == '__main__':
+    main()
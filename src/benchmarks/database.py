@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import click
+import numpy as np
+import pandas as pd
+
+from src.data.database import Database
+
+
+def synthetic_games(n_games, n_tags=150, tags_per_game=6, seed=0):
+    rng = np.random.RandomState(seed)
+    games = {}
+    for gid in range(1, n_games + 1):
+        game = {'gameid': gid, 'rank': gid, 'title': 'Game {}'.format(gid),
+                'url': 'http://www.boardgamegeek.com/boardgame/{}/game'.format(gid),
+                'year': int(rng.randint(1950, 2020)), 'publisher': 'Publisher',
+                'bggrating': float(rng.uniform(5, 9)), 'avgrating': float(rng.uniform(5, 9)),
+                'votes': int(rng.randint(0, 50000)), 'weight': float(rng.uniform(1, 5)),
+                'description': 'A game. ' * 40,
+                'updated': datetime(2020, 1, 1) + timedelta(seconds=int(rng.randint(1e7)))}
+        for tag in rng.choice(n_tags, tags_per_game, replace=False):
+            game['{}-tag {}'.format('cat' if tag % 2 else 'mech', tag)] = 1
+        games[gid] = game
+    return games
+
+
+def legacy_load(filename):
+    """Database.load and the dict round trip as they were before the single in-memory form"""
+    conn = sqlite3.connect(filename)
+    df = pd.read_sql_query("select * from games;", conn)
+    df.set_index('gameid', inplace=True, drop=False)
+    df['updated'] = df['updated'].apply(lambda x: Database.parse_date(x))
+    df.index.name = 'gameid'
+    conn.close()
+    return df.to_dict(orient='index')
+
+
+def legacy_save(games, filename):
+    df = pd.DataFrame.from_dict(games, orient='index')
+    df = df.where((pd.notnull(df)), None)
+    df['random'] = np.random.uniform(low=-0.5, high=0.5, size=(len(df),))
+    df.index.name = 'gameid'
+    games = df.to_dict(orient='index')
+    conn = sqlite3.connect(filename)
+    df.to_sql("games", conn, if_exists="replace", index=False)
+    conn.close()
+    return games
+
+
+def timed(func, *args, **kwargs):
+    t0 = perf_counter()
+    func(*args, **kwargs)
+    return perf_counter() - t0
+
+
+@click.command()
+@click.option('--games', 'n_games', default=20000, help='Number of synthetic games.')
+@click.option('--changed', default=100, help='Number of games changed before a checkpoint.')
+@click.option('--tag-storage', default='columns', type=click.Choice(['columns', 'table']))
+def main(n_games, changed, tag_storage):
+    """ Times loading and checkpointing a synthetic database, old code versus Database.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bgg.db')
+        db = Database(filename, tag_storage=tag_storage)
+        for game in synthetic_games(n_games).values():
+            db.set_game(game)
+        db.close()
+
+        results = [('load (legacy)', timed(legacy_load, filename))]
+        t0 = perf_counter()
+        db = Database(filename, tag_storage=tag_storage)
+        results.append(('load (Database)', perf_counter() - t0))
+        results.append(('save all (legacy)', timed(legacy_save, db.games, filename)))
+        for gid in list(db.games)[:changed]:
+            game = dict(db.get_game(gid))
+            game['updated'] = datetime.now()
+            db.set_game(game)
+        results.append(('save {} changed (Database)'.format(changed), timed(db.close)))
+        results.append(('save all (Database)', timed(db.close, full=True)))
+
+    for name, seconds in results:
+        print('{:<35} {:>9.1f} ms'.format(name, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+from datetime import datetime
+from timeit import repeat
+
+import click
+from bs4 import BeautifulSoup
+
+from src.data.cache import ResponseCache
+from src.data.parsers import parse_listing
+from src.data.scrape_data import SEARCH_URL
+
+ROW = '''
+<tr id='row_'>
+    <td class="collection_rank{cls}">
+        {rank}
+    </td>
+    <td class="collection_thumbnail">
+        <a href="/boardgame/{gid}/game-{gid}"><img alt="Board Game: Game {gid}" src="/thumb/{gid}.jpg"/></a>
+    </td>
+    <td class="collection_objectname{cls}" id="CEcell_objectname{row}">
+        <div style="z-index:1000;" id="results_objectname{row}">
+            <a href="/boardgame/{gid}/game-{gid}">Game {gid} &amp; friends</a>
+            <span class="smallerfont dull">({year})</span>
+        </div>
+        <p class="smallefont dull">A description of game {gid}, which is about trading.</p>
+    </td>
+    <td class="collection_bggrating{cls}">
+        {geek}
+    </td>
+    <td class="collection_bggrating{cls}">
+        {avg}
+    </td>
+    <td class="collection_bggrating{cls}">
+        {votes}
+    </td>
+    <td class="collection_shop"><a href="/boardgame/{gid}/game-{gid}/shop">Shop</a></td>
+</tr>'''
+
+
+def legacy_new_game(gamesoup, publisher):
+    """BGGGame.new_game as it was before parsers.parse_listing"""
+    game = {}
+    try:
+        game['rank'] = int(gamesoup.find("td", attrs={"class": "collection_rank"})
+                                   .find("a")['name'])
+    except TypeError:
+        game['rank'] = 999999
+    game['title'] = gamesoup.find("td", {"class": "collection_objectname"})\
+                            .find("a").contents[0]
+    game['url'] = "http://www.boardgamegeek.com" + \
+                  gamesoup.find("td", {"class": "collection_objectname"}).find("a")['href']
+    game['gameid'] = int(re.search(r'\/(\d*)\/',
+                                   gamesoup.find("td", {"class": "collection_objectname"})
+                                           .find("a")['href']).group(1))
+    try:
+        game['year'] = int(re.search(r'\((\d*)\)',
+                                     gamesoup.find("td", {"class": "collection_objectname"})
+                                             .find("span").contents[0]).group(1))
+    except AttributeError:
+        game['year'] = 1900
+    ratings = gamesoup.find_all("td", {"class": "collection_bggrating"})
+    try:
+        game['bggrating'] = float(ratings[0].contents[0])
+    except ValueError:
+        game['bggrating'] = None
+    try:
+        game['avgrating'] = float(ratings[1].contents[0])
+    except ValueError:
+        game['avgrating'] = None
+    try:
+        game['votes'] = int(ratings[2].contents[0])
+    except ValueError:
+        game['votes'] = 0
+    game['publisher'] = publisher
+    game['updated'] = datetime(2000, 1, 1)
+    return game
+
+
+def legacy_parse_listing(pagetext, publisher):
+    """BGGInterface.parse_listing as it was before parsers.parse_listing"""
+    soup = BeautifulSoup(pagetext, "html.parser")
+    games = [legacy_new_game(gamesoup, publisher)
+             for gamesoup in soup.find("div", attrs={"id": "collection"})
+                                 .find_all("tr", attrs={"id": "row_"})]
+    try:
+        next_url = "https://boardgamegeek.com" + soup.find("a", {"title": "next page"})['href']
+    except TypeError:
+        next_url = None
+    return games, next_url
+
+
+def synthetic_listing_page(n_rows=100, n_filler=300):
+    # some rows have a trailing space or an extra class in the class attributes of their cells
+    rows = ''.join(ROW.format(row=i, gid=1000 + i, year=1990 + i % 30,
+                              cls=['', ' ', ' highlight'][i % 3],
+                              rank='<a name="{0}"></a>{0}'.format(i + 1) if i % 7 else 'N/A',
+                              geek='{:.3f}'.format(5 + i % 40 / 10.) if i % 5 else 'N/A',
+                              avg='{:.2f}'.format(6 + i % 30 / 10.), votes=10 * i)
+                   for i in range(n_rows))
+    filler = '\n'.join('<li class="menu"><a href="/browse/{0}">Browse {0}</a></li>'.format(i)
+                       for i in range(n_filler))
+    return ('<html><head><title>Search</title></head><body><ul>{}</ul>'
+            '<div id="collection"><table class="collection_table">{}</table></div>'
+            '<a href="/search/boardgame/page/2?advsearch=1" title="next page">Next</a>'
+            '</body></html>'.format(filler, rows))
+
+
+def saved_listing_pages(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return []
+    cache = ResponseCache(cache_dir)
+    return [cache.entry(url)[0] for url in cache.urls(SEARCH_URL)]
+
+
+@click.command()
+@click.option('--cache-dir', default='data/raw/responses', type=click.Path(),
+              help='Response cache with saved search result pages.')
+@click.option('--number', default=5, help='Number of passes over all pages per timing.')
+def main(cache_dir, number):
+    """ Times parsing search result pages, old BeautifulSoup path versus parse_listing,
+        after checking that both give the same games.
+    """
+    pages = saved_listing_pages(cache_dir)
+    if not pages:
+        print("No saved result pages found in {}, using a synthetic page instead".format(cache_dir))
+        pages = [synthetic_listing_page()]
+    for page in pages:
+        assert legacy_parse_listing(page, 'Publisher') == parse_listing(page, 'Publisher')
+    for name, parser in [('legacy (BeautifulSoup)', legacy_parse_listing),
+                         ('parse_listing (lxml)', parse_listing)]:
+        best = min(repeat(lambda: [parser(page, 'Publisher') for page in pages],
+                          number=number, repeat=3))
+        print('{:<30} {:>8.3f} ms per page'.format(name, best / number / len(pages) * 1000))
+
+
+if __name__ == '__main__':
+    main()
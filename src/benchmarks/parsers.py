@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+from timeit import repeat
+
+import click
+import numpy as np
+from bs4 import BeautifulSoup
+
+from src.data.cache import ResponseCache
+from src.data.parsers import BGG_URL, PRELOAD_MARKER, extract_geekitem_preload
+
+
+def legacy_geekitem_preload(pagetext):
+    """The parsing path BGGGame.update_gamedata used before extract_geekitem_preload"""
+    soup = BeautifulSoup(pagetext, "html.parser")
+    gameinfo = re.search(r'geekitemPreload = (\{.*\}\});', soup.find("script").contents[0]).group(1)
+    return eval(gameinfo.replace("true", "True")
+                        .replace("false", "False")
+                        .replace("null", "np.nan"), {'np': np})
+
+
+def synthetic_game_page(n_filler=2000):
+    item = {'item': {'objectid': '13', 'minplaytime': '60', 'maxplaytime': '120',
+                     'rankinfo': [{'subdomain': None}, {'subdomain': 'strategygames'}],
+                     'polls': {'boardgameweight': {'averageweight': 2.3, 'votes': 5000},
+                               'playerage': '10+',
+                               'userplayers': {'best': [{'min': 3, 'max': 4}],
+                                               'recommended': [{'min': 3, 'max': 4}],
+                                               'totalvotes': '1500'}},
+                     'stats': {'numplays': 50000, 'numplays_month': 900, 'avgweight': None},
+                     'links': {'boardgamecategory': [{'name': 'Negotiation', 'objectid': str(i)}
+                                                     for i in range(50)]},
+                     'description': 'A game about trading & building. ' * 50,
+                     'ispublic': True, 'isexpansion': False}}
+    filler = '\n'.join('<div class="row"><a href="/boardgame/{0}">Game {0}</a></div>'.format(i)
+                       for i in range(n_filler))
+    return ('<html><head><script type="text/javascript">GEEK.geekitemPreload = {};'
+            '</script></head><body>{}</body></html>'.format(json.dumps(item), filler))
+
+
+def saved_game_pages(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return []
+    cache = ResponseCache(cache_dir)
+    pages = (cache.entry(url) for url in cache.urls(BGG_URL + '/boardgame/'))
+    return [entry[0] for entry in pages if entry is not None and PRELOAD_MARKER in entry[0]]
+
+
+def same_gameinfo(a, b):
+    """Whether two decoded geekitemPreload objects are equal, with NaN equal to NaN"""
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same_gameinfo(a[key], b[key]) for key in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(same_gameinfo(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) and isinstance(b, float) and np.isnan(a) and np.isnan(b):
+        return True
+    return type(a) == type(b) and a == b
+
+
+@click.command()
+@click.option('--cache-dir', default='data/raw/responses', type=click.Path(),
+              help='Response cache with saved game pages.')
+@click.option('--number', default=5, help='Number of passes over all pages per timing.')
+def main(cache_dir, number):
+    """ Times the geekitemPreload extraction on saved game pages, old path versus new,
+        after checking that both give the same objects.
+    """
+    pages = saved_game_pages(cache_dir)
+    if not pages:
+        print("No saved game pages found in {}, using a synthetic page instead".format(cache_dir))
+        pages = [synthetic_game_page()]
+    for page in pages:
+        assert same_gameinfo(legacy_geekitem_preload(page), extract_geekitem_preload(page))
+    for name, parser in [('legacy (BeautifulSoup + eval)', legacy_geekitem_preload),
+                         ('extract_geekitem_preload', extract_geekitem_preload)]:
+        best = min(repeat(lambda: [parser(page) for page in pages], number=number, repeat=3))
+        print('{:<30} {:>8.3f} ms per page'.format(name, best / number / len(pages) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import resource
+import sys
+import tempfile
+from datetime import datetime
+from itertools import islice
+from multiprocessing import Process
+from time import perf_counter, process_time
+
+import click
+import requests
+
+from src.benchmarks.stub_server import StubBGG, make_server
+from src.data.cache import ResponseCache
+from src.data.database import Database
+from src.data.metrics import METRICS
+from src.data.scrape_data import BGGInterface
+
+
+def cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return process_time() + children.ru_utime + children.ru_stime
+
+
+def stub_stats(base_url):
+    return requests.get(base_url + '/_stats').json()
+
+
+def measure(name, base_url, func, count_games):
+    """Run func with its output silenced and return its throughput, CPU time and peak memory.
+    The CPU time includes the worker processes that finished during func."""
+    stats = stub_stats(base_url)
+    t0, cpu0 = perf_counter(), cpu_time()
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            func()
+        finally:
+            sys.stdout = stdout
+    seconds, cpu = perf_counter() - t0, cpu_time() - cpu0
+    after = stub_stats(base_url)
+    games = count_games()
+    return {'stage': name, 'games': games, 'seconds': seconds,
+            'games_per_second': games / seconds,
+            'requests_per_second': (after['requests'] - stats['requests']) / seconds,
+            'throttled': after['throttled'] - stats['throttled'],
+            'cpu_seconds': cpu,
+            'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+
+
+def run_benchmark(base_url, publishers, workers, parse_workers, requests_per_second):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bgg.db'), tag_storage='table')
+        bgg = BGGInterface(db, base_url=base_url)
+        bgg.publishers = dict(islice(bgg.publishers.items(), publishers))
+        results = [measure('add_new_games', base_url,
+                           lambda: bgg.add_new_games(workers=workers,
+                                                     requests_per_second=requests_per_second),
+                           lambda: len(db.games))]
+        started = datetime.now()
+        results.append(measure(
+            'update_all_game_details', base_url,
+            lambda: bgg.update_all_game_details(workers=workers, parse_workers=parse_workers,
+                                                requests_per_second=requests_per_second),
+            lambda: sum(1 for game in db.games.values() if game['updated'] >= started)))
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    baseline = {result['stage']: result for result in baseline}
+    for result in results:
+        before = baseline.get(result['stage'])
+        if before is not None and \
+                result['games_per_second'] < (1 - tolerance) * before['games_per_second']:
+            yield '{} dropped from {:.1f} to {:.1f} games/s'.format(
+                result['stage'], before['games_per_second'], result['games_per_second'])
+
+
+@click.command()
+@click.option('--publishers', default=5, help='Number of publishers to crawl.')
+@click.option('--pages', default=3, help='Search result pages per publisher.')
+@click.option('--rows', default=100, help='Games per search result page.')
+@click.option('--latency', default=0.02, help='Seconds the stub server waits per response.')
+@click.option('--throttle-rate', default=0.02, help='Fraction of requests answered with a 429.')
+@click.option('--recordings', type=click.Path(), default=None,
+              help='Response cache directory with recorded responses to serve.')
+@click.option('--workers', default=4)
+@click.option('--parse-workers', default=0)
+@click.option('--requests-per-second', default=1000.)
+@click.option('--output', type=click.Path(), default=None, help='Write the results as JSON.')
+@click.option('--baseline', type=click.Path(exists=True), default=None,
+              help='JSON results of an earlier run to compare with.')
+@click.option('--tolerance', default=0.2, help='Allowed drop in games/s against the baseline.')
+@click.option('--metrics-dir', type=click.Path(), default=None,
+              help='Record the scraper metrics and write them to this directory.')
+def main(publishers, pages, rows, latency, throttle_rate, recordings, workers, parse_workers,
+         requests_per_second, output, baseline, tolerance, metrics_dir):
+    """ Runs add_new_games and update_all_game_details against a local stand-in for
+        boardgamegeek.com and reports their throughput, CPU time and peak memory.
+        With --baseline, exits with status 1 when a stage got slower than the tolerance.
+    """
+    if metrics_dir is not None:
+        METRICS.enable()
+    cache = ResponseCache(recordings) if recordings and os.path.isdir(recordings) else None
+    stub = StubBGG(cache, pages_per_publisher=pages, rows_per_page=rows, latency=latency,
+                   throttle_rate=throttle_rate)
+    server = make_server(stub)
+    base_url = 'http://{}:{}'.format(*server.server_address)
+    # the server runs in its own process, so it doesn't share the CPU time or GIL of the scraper
+    server_process = Process(target=server.serve_forever, daemon=True)
+    server_process.start()
+    server.socket.close()
+    try:
+        results = run_benchmark(base_url, publishers, workers, parse_workers,
+                                requests_per_second)
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+    print('{:<25} {:>7} {:>9} {:>9} {:>10} {:>9} {:>9} {:>10}'.format(
+        'stage', 'games', 'seconds', 'games/s', 'requests/s', 'throttled', 'cpu s', 'peak MB'))
+    for r in results:
+        print('{stage:<25} {games:>7} {seconds:>9.2f} {games_per_second:>9.1f} '
+              '{requests_per_second:>10.1f} {throttled:>9} {cpu_seconds:>9.2f} '
+              '{peak_memory_mb:>10.1f}'.format(**r))
+    if metrics_dir is not None:
+        METRICS.write(metrics_dir)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            failures = list(regressions(results, json.load(f), tolerance))
+        for failure in failures:
+            print('Regression: ' + failure)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import random
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+import click
+
+from src.benchmarks.listing import ROW
+from src.benchmarks.parsers import synthetic_game_page
+from src.data.cache import ResponseCache
+from src.data.fetch import BGG_HOSTS
+
+THING_ITEM = ('<item type="boardgame" id="{gid}"><description>A game about trading &amp;amp; '
+              'building, number {gid}.</description><minplayers value="{minp}"/>'
+              '<maxplayers value="{maxp}"/><minage value="10"/>'
+              '<link type="boardgamecategory" id="1" value="{cat}"/>'
+              '<link type="boardgamecategory" id="2" value="Negotiation"/>'
+              '<link type="boardgamemechanic" id="3" value="{mech}"/></item>')
+
+
+class StubBGG:
+    """The responses of a stand-in for boardgamegeek.com: the recorded ones of a ResponseCache
+    when there is one for a url, and otherwise generated search result pages, game pages and
+    XML API responses for pages_per_publisher pages of rows_per_page games per publisher.
+
+    Every request waits latency seconds, and game pages and XML API requests are answered
+    with a 429 Too Many Requests and a Retry-After of retry_after seconds with probability
+    throttle_rate. Search pages are never throttled, as the listing crawl doesn't retry.
+    """
+    def __init__(self, recordings=None, pages_per_publisher=3, rows_per_page=100, latency=0.,
+                 throttle_rate=0., retry_after=1, seed=0):
+        self.recordings = recordings
+        self.pages_per_publisher = pages_per_publisher
+        self.rows_per_page = rows_per_page
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.game_page = synthetic_game_page(n_filler=500)
+        self.lock = Lock()
+        self.stats = {'requests': 0, 'throttled': 0, 'not_modified': 0, 'bytes': 0}
+
+    def respond(self, path, headers):
+        """Return the status, headers and body for the path and query of a request"""
+        if self.latency:
+            sleep(self.latency)
+        url = urlsplit(path)
+        if url.path == '/_stats':
+            return 200, {'Content-Type': 'application/json'}, json.dumps(self.stats).encode()
+        with self.lock:
+            self.stats['requests'] += 1
+            throttle = not url.path.startswith('/search/') and \
+                self.random.random() < self.throttle_rate
+        if throttle:
+            self.count('throttled')
+            return 429, {'Retry-After': str(self.retry_after)}, b'Rate limit exceeded'
+        body, content_type = self.recorded(path)
+        if body is None:
+            body, content_type = self.generated(url)
+        if body is None:
+            return 404, {}, b'Not found'
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if headers.get('If-None-Match') == etag:
+            self.count('not_modified')
+            return 304, {'ETag': etag}, b''
+        self.count('bytes', len(body))
+        return 200, {'Content-Type': content_type, 'ETag': etag}, body
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    def recorded(self, path):
+        if self.recordings is None:
+            return None, None
+        for host in BGG_HOSTS:
+            for scheme in ('https', 'http'):
+                text = self.recordings.entry('{}://{}{}'.format(scheme, host, path))
+                if text is not None:
+                    is_xml = path.startswith('/xmlapi2/')
+                    return text[0].encode('utf-8'), 'text/xml' if is_xml else 'text/html'
+        return None, None
+
+    def generated(self, url):
+        query = parse_qs(url.query)
+        match = re.match(r'/search/boardgame/page/(\d+)$', url.path)
+        if match and 'include[publisherid]' in query:
+            page = self.listing_page(int(query['include[publisherid]'][0]), int(match.group(1)),
+                                     url.query)
+            return page.encode('utf-8'), 'text/html'
+        if re.match(r'/boardgame/\d+/', url.path):
+            return self.game_page.encode('utf-8'), 'text/html'
+        if url.path == '/xmlapi2/thing' and 'id' in query:
+            gameids = [int(gid) for gid in query['id'][0].split(',')]
+            return self.things(gameids).encode('utf-8'), 'text/xml'
+        return None, None
+
+    def listing_page(self, publisherid, page, query):
+        if page > self.pages_per_publisher:
+            rows = ''
+        else:
+            first = (publisherid * self.pages_per_publisher + page - 1) * self.rows_per_page
+            rows = ''.join(ROW.format(row=i, gid=first + i, year=1990 + i % 30,
+                                      cls='',
+                                      rank='<a name="{0}"></a>{0}'.format(first + i),
+                                      geek='{:.3f}'.format(5 + i % 40 / 10.),
+                                      avg='{:.2f}'.format(6 + i % 30 / 10.), votes=10 * i)
+                           for i in range(self.rows_per_page))
+        next_page = ''
+        if page < self.pages_per_publisher:
+            next_page = '<a href="/search/boardgame/page/{}?{}" title="next page">Next</a>'\
+                .format(page + 1, query)
+        return ('<html><body><div id="collection"><table class="collection_table">{}</table>'
+                '</div>{}</body></html>'.format(rows, next_page))
+
+    @staticmethod
+    def things(gameids):
+        items = ''.join(THING_ITEM.format(gid=gid, minp=1 + gid % 2, maxp=2 + gid % 5,
+                                          cat=['Card Game', 'Fantasy', 'Economic'][gid % 3],
+                                          mech=['Dice Rolling', 'Trading'][gid % 2])
+                        for gid in gameids)
+        return '<?xml version="1.0" encoding="utf-8"?><items>{}</items>'.format(items)
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, headers, body = self.server.stub.respond(self.path, self.headers)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(stub, host='127.0.0.1', port=0):
+    """A threaded HTTP server for stub; port 0 picks a free port, see server.server_address"""
+    server = ThreadingHTTPServer((host, port), StubRequestHandler)
+    server.daemon_threads = True
+    server.stub = stub
+    return server
+
+
+@click.command()
+@click.option('--port', default=8000)
+@click.option('--recordings', type=click.Path(), default=None,
+              help='Response cache directory with recorded responses to serve.')
+@click.option('--pages', default=3, help='Search result pages per publisher.')
+@click.option('--rows', default=100, help='Games per search result page.')
+@click.option('--latency', default=0., help='Seconds to wait before every response.')
+@click.option('--throttle-rate', default=0., help='Fraction of requests answered with a 429.')
+def main(port, recordings, pages, rows, latency, throttle_rate):
+    """ Serves a local stand-in for boardgamegeek.com, to point BGGInterface(base_url=...) at.
+    """
+    cache = ResponseCache(recordings) if recordings and os.path.isdir(recordings) else None
+    stub = StubBGG(cache, pages_per_publisher=pages, rows_per_page=rows, latency=latency,
+                   throttle_rate=throttle_rate)
+    server = make_server(stub, port=port)
+    print('Serving a stand-in for boardgamegeek.com on http://127.0.0.1:{}'.format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import gzip
+import hashlib
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from threading import Lock
+
+from src.data.database import DATE_FORMAT
+
+
+class ResponseCache:
+    """On-disk cache of raw responses, so pages can be re-parsed without downloading them again.
+
+    The bodies are stored gzipped under the sha256 of their contents, and an index maps every
+    url to its body. Within ttl a cached body is served instead of a request; after that it is
+    only kept for reparsing. When the bodies take more than max_bytes, the least recently used
+    ones are evicted.
+    """
+    def __init__(self, directory='data/raw/responses', ttl=timedelta(days=1), max_bytes=2 * 1024**3):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.directory, 'index.db'),
+                                    check_same_thread=False)
+        with self.conn:
+            self.conn.execute("create table if not exists responses "
+                              "(url text primary key, digest text, size integer, "
+                              "fetched text, accessed text);")
+            self.conn.execute("create index if not exists responses_accessed "
+                              "on responses (accessed);")
+        self.total_bytes = self.conn.execute(
+            "select coalesce(sum(size), 0) from "
+            "(select distinct digest, size from responses);").fetchone()[0]
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + '.gz')
+
+    def get(self, url):
+        """Return the cached body of a url if it was fetched within ttl, otherwise None"""
+        entry = self.entry(url)
+        if entry is None or datetime.now() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def entry(self, url):
+        """Return the cached body of a url and when it was fetched, however old, or None"""
+        with self.lock:
+            row = self.conn.execute("select digest, fetched from responses where url = ?;",
+                                    (url,)).fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                self.conn.execute("update responses set accessed = ? where url = ?;",
+                                  (datetime.now().strftime(DATE_FORMAT), url))
+        try:
+            with gzip.open(self.blob_path(row[0]), 'rt', encoding='utf-8') as f:
+                return f.read(), datetime.strptime(row[1], DATE_FORMAT)
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        now = datetime.now().strftime(DATE_FORMAT)
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with gzip.open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+                self.total_bytes += os.path.getsize(path)
+            old = self.conn.execute("select digest from responses where url = ?;",
+                                    (url,)).fetchone()
+            with self.conn:
+                self.conn.execute("insert or replace into responses "
+                                  "(url, digest, size, fetched, accessed) values (?, ?, ?, ?, ?);",
+                                  (url, digest, os.path.getsize(path), now, now))
+            if old is not None and old[0] != digest:
+                self.remove_unused_blob(old[0])
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        rows = self.conn.execute("select url, digest from responses order by accessed;").fetchall()
+        evicted = set()
+        for url, digest in rows:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            evicted.add(url)
+            self.remove_unused_blob(digest, ignore=evicted)
+        with self.conn:
+            self.conn.executemany("delete from responses where url = ?;",
+                                  ((url,) for url in evicted))
+
+    def remove_unused_blob(self, digest, ignore=()):
+        urls = self.conn.execute("select url from responses where digest = ?;",
+                                 (digest,)).fetchall()
+        if all(url in ignore for url, in urls):
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                self.total_bytes -= os.path.getsize(path)
+                os.remove(path)
+
+    def urls(self, prefix=''):
+        with self.lock:
+            rows = self.conn.execute("select url from responses where url like ? escape '\\';",
+                                     (prefix.replace('\\', '\\\\').replace('%', '\\%')
+                                            .replace('_', '\\_') + '%',)).fetchall()
+        return [url for url, in rows]
@@ -1,60 +1,246 @@
+import os
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
+from heapq import merge
 
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
+
+from src.data.metrics import METRICS
+from src.data import snapshot
+from src.data.history import HistoryStore
+
+TAG_KINDS = ('cat', 'mech')
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
 
 
 class Database:
-    def __init__(self, filename='data/processed/bgg.db'):
+    def __init__(self, filename='data/processed/bgg.db', tag_storage='columns', snapshot_file=True,
+                 history_file=True):
+        """tag_storage is either 'columns', with a cat-*/mech-* column per tag in the games
+        table, or 'table', with the tags in a separate game_tags(gameid, kind, tag) table.
+
+        The final save of a run, close(snapshot=True), also writes a columnar snapshot of the
+        games to snapshot_file, by default next to filename with the .arrow extension, to be
+        read with snapshot.Snapshot. It is skipped when snapshot_file is None or pyarrow isn't
+        installed.
+
+        The ratings, votes and play counts of the saved games are also appended to a
+        HistoryStore in history_file, by default next to filename with the .history extension,
+        unless history_file is None."""
         self.filename = filename
+        self.tag_storage = tag_storage
+        if snapshot_file is True:
+            snapshot_file = os.path.splitext(filename)[0] + '.arrow'
+        self.snapshot_file = snapshot_file
+        if history_file is True:
+            history_file = os.path.splitext(filename)[0] + '.history'
+        self.history = HistoryStore(history_file) if history_file is not None else None
         self.conn = None
+        self.dirty = set()
+        self.tags = {}
+        self.needs_full_save = False
+        self._df = None
         self.games = self.load()
         self.df = None
         print(len(self.games))
 
+    @property
+    def df(self):
+        if self._df is None and self.games:
+            self.games_as_df()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+
     def load(self):
         self.conn = sqlite3.connect(self.filename)
         try:
-            df = pd.read_sql_query("select * from games;", self.conn)
-            df.set_index('gameid', inplace=True, drop=False)
-            df['updated'] = df['updated'].apply(lambda x: self.parse_date(x))
-            df.index.name = 'gameid'
-            self.df = df
-        except pd.io.sql.DatabaseError:
+            cursor = self.conn.execute("select * from games;")
+        except sqlite3.OperationalError:
             print("The games table cannot be found in the database. " +
                   "Therefore, I'm initalizing the database from scratch")
             self.conn.close()
             return {}
-        else:
-            df_dict = self.df.to_dict(orient='index')
-            print("database at {} loaded".format(self.filename))
-            self.conn.close()
-            return df_dict
+        columns = [description[0] for description in cursor.description]
+        rows = cursor.fetchall()
+        games = {}
+        for row in rows:
+            game = {col: np.nan if value is None else value for col, value in zip(columns, row)}
+            games[game['gameid']] = game
+        if 'updated' in columns:
+            gameid, updated = columns.index('gameid'), columns.index('updated')
+            dates = self.parse_dates([row[updated] for row in rows])
+            for row, date in zip(rows, dates):
+                games[row[gameid]]['updated'] = date
+        if self.tag_storage == 'table':
+            games = self.load_tags(games, columns)
+        print("database at {} loaded".format(self.filename))
+        self.conn.close()
+        return games
+
+    def load_tags(self, games, columns):
+        try:
+            rows = self.conn.execute("select gameid, kind, tag from game_tags;").fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        for gameid, kind, tag in rows:
+            self.tags.setdefault(gameid, []).append((kind, tag))
+        if any(self.is_tag_column(col) for col in columns):
+            # The games table still has a column per tag, so move them to game_tags
+            for gameid in games:
+                games[gameid], self.tags[gameid] = self.split_tags(games[gameid])
+            self.needs_full_save = True
+        return games
+
+    @staticmethod
+    def is_tag_column(col):
+        return col.split('-', 1)[0] in TAG_KINDS and '-' in col
+
+    def split_tags(self, game):
+        tags = [tuple(key.split('-', 1)) for key, value in game.items()
+                if self.is_tag_column(key) and value == 1]
+        return {key: value for key, value in game.items() if not self.is_tag_column(key)}, tags
 
     @staticmethod
     def parse_date(date_string):
         if isinstance(date_string, str):
-            return datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S.%f')
+            return datetime.strptime(date_string, DATE_FORMAT)
         else:
             return date_string
 
-    def close(self):
-        self.games_as_df()
+    @staticmethod
+    def parse_dates(date_strings):
+        """Vectorized parse_date, which also accepts dates without microseconds"""
+        date_strings = pd.Series(date_strings, dtype=object)
+        dates = pd.to_datetime(date_strings, format=DATE_FORMAT, errors='coerce')
+        missed = dates.isnull() & date_strings.notnull()
+        if missed.any():
+            dates[missed] = pd.to_datetime(date_strings[missed], errors='coerce')
+        return [date.to_pydatetime() if pd.notnull(date) else np.nan for date in dates]
+
+    def close(self, full=False, snapshot=False):
+        """Save the games, only the ones set since the last save unless full. The snapshot
+        is rewritten for all games, so checkpoints during a run leave it out."""
         self.conn = sqlite3.connect(self.filename)
         try:
-            cur = self.conn.cursor()
-            count_info = cur.execute("select count(*) as n from games;").fetchall()
-            cur.close()
-            n = count_info[0][0]
-        except sqlite3.OperationalError:
-            n = 0
-        if len(self.df) < n:
-            raise GamesDisappearedError
-        else:
-            self.df.to_sql("games", self.conn, if_exists="replace", index=False)
+            try:
+                n = self.conn.execute("select count(*) as n from games;").fetchone()[0]
+                columns = [info[1] for info in self.conn.execute("pragma table_info(games);")]
+            except sqlite3.OperationalError:
+                n = 0
+                columns = []
+            if len(self.games) < n:
+                raise GamesDisappearedError
+            if full or not columns or self.needs_full_save:
+                with METRICS.timer('checkpoint_seconds', mode='full'):
+                    self.save_all()
+                METRICS.count('games_saved_total', len(self.games))
+            else:
+                with METRICS.timer('checkpoint_seconds', mode='dirty'):
+                    try:
+                        self.save_dirty(columns)
+                    except sqlite3.IntegrityError:
+                        self.save_all()
+                METRICS.count('games_saved_total', len(self.dirty))
+            self.record_history()
+            self.dirty = set()
             print("         Data saved at {}".format(self.filename))
-        self.conn.close()
+            if snapshot:
+                self.write_snapshot()
+        finally:
+            self.conn.close()
+
+    def save_all(self):
+        self.games_as_df()
+        df = self.df
+        if 'updated' in df:
+            df = df.assign(updated=df['updated'].map(self.sql_value))
+        df.to_sql("games", self.conn, if_exists="replace", index=False)
+        self.create_indexes()
+        if self.tag_storage == 'table':
+            self.conn.execute("drop table if exists game_tags;")
+            self.save_tags(self.games)
+        self.conn.commit()
+        self.needs_full_save = False
+
+    def record_history(self):
+        """Append the values of the games set since the last save to the history, as observed
+        when they were updated, or now for games that were only listed so far"""
+        if self.history is None:
+            return
+        now = datetime.now()
+        observations = []
+        for gid in sorted(self.dirty):
+            game = self.games.get(gid)
+            if game is None:
+                continue
+            updated = game.get('updated')
+            when = updated if isinstance(updated, datetime) and updated > datetime(2000, 1, 1) \
+                else now
+            observations.append((gid, when, game))
+        self.history.append(observations)
+
+    def write_snapshot(self):
+        if self.snapshot_file is None or not snapshot.available() or not self.games:
+            return
+        with METRICS.timer('snapshot_seconds'):
+            df = self.df
+            df = df[[col for col in df.columns if not self.is_tag_column(col)]]
+            snapshot.write_snapshot(self.snapshot_file, df,
+                                    {kind: [self.get_tags(gid, kind) for gid in df.index]
+                                     for kind in TAG_KINDS})
+
+    def save_dirty(self, columns):
+        """Upsert only the games that were set since the last save, in a single transaction"""
+        games = [self.games[gid] for gid in self.dirty]
+        self.assign_random(games)
+        new_columns = sorted({col for game in games for col in game} - set(columns))
+        columns = columns + new_columns
+        with self.conn:
+            self.conn.execute("begin;")
+            self.create_indexes()
+            for col in new_columns:
+                self.conn.execute("alter table games add column {};".format(self.quote(col)))
+            self.conn.executemany(
+                "insert or replace into games ({}) values ({});".format(
+                    ', '.join(self.quote(col) for col in columns), ', '.join('?' * len(columns))),
+                ([self.sql_value(game.get(col)) for col in columns] for game in games))
+            if self.tag_storage == 'table':
+                self.save_tags(self.dirty)
+
+    def save_tags(self, gameids):
+        self.conn.execute("create table if not exists game_tags "
+                          "(gameid integer, kind text, tag text);")
+        self.conn.execute("create index if not exists game_tags_gameid on game_tags (gameid);")
+        self.conn.executemany("delete from game_tags where gameid = ?;",
+                              ((gid,) for gid in gameids))
+        self.conn.executemany("insert into game_tags (gameid, kind, tag) values (?, ?, ?);",
+                              ((gid, kind, tag) for gid in gameids
+                               for kind, tag in self.tags.get(gid, [])))
+
+    def create_indexes(self):
+        self.conn.execute("create unique index if not exists games_gameid on games (gameid);")
+        # stale games are read in (rank, gameid) order, filtering on updated within the index
+        self.conn.execute("create index if not exists games_rank_gameid_updated "
+                          "on games (rank, gameid, updated);")
+
+    @staticmethod
+    def quote(identifier):
+        return '"{}"'.format(identifier.replace('"', '""'))
+
+    @staticmethod
+    def sql_value(value):
+        if isinstance(value, datetime):
+            return value.strftime(DATE_FORMAT)
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, float) and np.isnan(value):
+            return None
+        return value
 
     def set_game(self, game, overwrite=True, verbose=False):
         try:
@@ -68,7 +254,18 @@ class Database:
                 if verbose:
                     print("Game id {} is already in the database".format(game['gameid']))
             else:
+                if self.tag_storage == 'table':
+                    game, self.tags[game['gameid']] = self.split_tags(game)
                 self.games[game['gameid']] = game
+                self.dirty.add(game['gameid'])
+                self._df = None
+
+    def set_columns(self, df, columns):
+        """Copy columns of a DataFrame indexed by gameid, e.g. computed features, to the games"""
+        for gid, values in zip(df.index, df[columns].to_dict(orient='records')):
+            self.games[gid].update(values)
+            self.dirty.add(gid)
+        self._df = None
 
     def get_game(self, gameid):
         try:
@@ -77,6 +274,13 @@ class Database:
             print("Game id {} does not exist in the database.".format(e.args[0]))
             raise GameNotInDatabaseError(gameid=gameid)
 
+    def game_with_tags(self, gameid):
+        """Return a copy of a game with its tags as cat-*/mech-* keys, whatever the tag_storage"""
+        game = dict(self.get_game(gameid))
+        if self.tag_storage == 'table':
+            game.update({kind + '-' + tag: 1 for kind, tag in self.tags.get(gameid, [])})
+        return game
+
     def print(self):
         for game in self.games:
             self.games[game].print()
@@ -86,12 +290,98 @@ class Database:
         sorted_tuples = sorted(list_of_tuples, key=lambda x: x[1], reverse=reverse)
         return [k for k, v in sorted_tuples]
 
+    def get_tags(self, gameid, kind):
+        if self.tag_storage == 'table':
+            return [tag for k, tag in self.tags.get(gameid, []) if k == kind]
+        return [key.split('-', 1)[1] for key, value in self.games[gameid].items()
+                if key.startswith(kind + '-') and value == 1]
+
+    def tag_matrix(self, kind, gameids=None):
+        """Rebuild the one-hot matrix of one kind of tags ('cat' or 'mech') as a sparse matrix.
+
+        Returns the CSR matrix with a row per game in gameids and the matching column names,
+        e.g. 'cat-economic'. The columns cover the tags of all games in the database.
+        """
+        if gameids is None:
+            gameids = list(self.games)
+        vocabulary = sorted({tag for gid in self.games for tag in self.get_tags(gid, kind)})
+        col_idx = {tag: idx for idx, tag in enumerate(vocabulary)}
+        rows, cols = [], []
+        for row, gid in enumerate(gameids):
+            for tag in self.get_tags(gid, kind):
+                rows.append(row)
+                cols.append(col_idx[tag])
+        matrix = csr_matrix((np.ones(len(rows)), (rows, cols)),
+                            shape=(len(gameids), len(vocabulary)))
+        return matrix, [kind + '-' + tag for tag in vocabulary]
+
+    @staticmethod
+    def fingerprint(filename):
+        """The number of saved games and the last time one was updated, read without loading
+        the database. Scraping changes it, writing computed columns of the games doesn't."""
+        conn = sqlite3.connect(filename)
+        try:
+            return list(conn.execute("select count(*), max(updated) from games;").fetchone())
+        except sqlite3.OperationalError:
+            return [0, None]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def assign_random(games):
+        for game in games:
+            if 'random' not in game:
+                game['random'] = np.random.uniform(low=-0.5, high=0.5)
+
+    def is_fresh(self, gameid, freshness):
+        try:
+            return (datetime.now() - self.games[gameid]['updated']).days <= freshness
+        except (KeyError, AttributeError, TypeError):
+            return False
+
+    def stale_gameids(self, freshness=60, page_size=500):
+        """Yield the ids of the games not updated in the last freshness days, ordered by rank.
+
+        The saved games are read page by page by walking the (rank, gameid, updated) index from
+        the last id of the previous page, so the first ids are available right away, no page
+        sorts and fresh games are skipped without reading their rows. Games that were set but
+        not saved yet are merged in.
+        """
+        unsaved = set(self.dirty)
+        saved = self.saved_stale_gameids(datetime.now() - timedelta(days=freshness + 1),
+                                         page_size, skip=unsaved)
+        unsaved = sorted((self.games[gid]['rank'], gid) for gid in unsaved if gid in self.games)
+        for rank, gid in merge(saved, unsaved):
+            if not self.is_fresh(gid, freshness):
+                yield gid
+
+    def saved_stale_gameids(self, cutoff, page_size, skip=()):
+        last = (-np.inf, -np.inf)
+        while True:
+            conn = sqlite3.connect(self.filename)
+            try:
+                page = conn.execute(
+                    "select rank, gameid from games "
+                    "where (updated is null or updated <= ?) "
+                    "and (rank, gameid) > (?, ?) "
+                    "order by rank, gameid limit ?;",
+                    (cutoff.strftime(DATE_FORMAT), last[0], last[1], page_size)).fetchall()
+            except sqlite3.OperationalError:
+                page = []
+            finally:
+                conn.close()
+            for rank, gid in page:
+                if gid not in skip:
+                    yield rank, gid
+            if len(page) < page_size:
+                break
+            last = page[-1]
+
     def games_as_df(self):
+        self.assign_random(self.games.values())
         df = pd.DataFrame.from_dict(self.games, orient='index')
         df = df.where((pd.notnull(df)), None)
-        df['random'] = np.random.uniform(low=-0.5, high=0.5, size=(len(df),))
         df.index.name = 'gameid'
-        self.games = df.to_dict(orient='index')
         self.df = df
 
 
@@ -0,0 +1,122 @@
+import sqlite3
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.data.metrics import METRICS
+
+BGG_HOSTS = ('boardgamegeek.com', 'www.boardgamegeek.com')
+
+
+class Fetcher:
+    """Shared HTTP session for all requests of the scraper.
+
+    It keeps connections alive in a pool, asks for gzip compressed responses and makes
+    conditional requests with the ETag and Last-Modified validators it has seen for a url.
+    The validators are stored in the http_validators table of the given SQLite file.
+    With a ResponseCache, responses are stored in it and served from it while fresh.
+    With a base_url, e.g. of a local stand-in server, the requests for boardgamegeek.com are
+    sent there instead; validators and cached responses are still kept by the original url.
+    """
+    def __init__(self, filename=None, pool_size=10, timeout=60, cache=None, base_url=None):
+        self.filename = filename
+        self.timeout = timeout
+        self.cache = cache
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        self.lock = Lock()
+        self.changed = set()
+        self.validators = self.load()
+
+    def load(self):
+        if self.filename is None:
+            return {}
+        conn = sqlite3.connect(self.filename)
+        try:
+            rows = conn.execute("select url, etag, last_modified from http_validators;").fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        finally:
+            conn.close()
+        return {url: (etag, last_modified) for url, etag, last_modified in rows}
+
+    def save(self):
+        if self.filename is None or not self.changed:
+            return
+        with self.lock:
+            rows = [(url,) + self.validators[url] for url in self.changed]
+            self.changed = set()
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            conn.execute("create table if not exists http_validators "
+                         "(url text primary key, etag text, last_modified text);")
+            conn.executemany("insert or replace into http_validators (url, etag, last_modified) "
+                             "values (?, ?, ?);", rows)
+        conn.close()
+
+    def get(self, url, params=None, conditional=True):
+        """GET a url. With conditional=True the response can be a 304 Not Modified, which means
+        the page didn't change since the last response that was passed to remember."""
+        if self.cache is not None:
+            full_url = self.full_url(url, params)
+            text = self.cache.get(full_url)
+            if text is not None:
+                METRICS.count('cache_hits_total')
+                return self.cached_response(full_url, text)
+        headers = {}
+        if conditional:
+            etag, last_modified = self.validators.get(url, (None, None))
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        with METRICS.timer('fetch_seconds'):
+            response = self.session.get(self.route(url), params=params, headers=headers,
+                                        timeout=self.timeout)
+        METRICS.count('responses_total', status=response.status_code)
+        if self.cache is not None and response.status_code == 200:
+            self.cache.put(full_url, response.text)
+        return response
+
+    def route(self, url):
+        if self.base_url is None:
+            return url
+        parts = urlsplit(url)
+        if parts.netloc not in BGG_HOSTS:
+            return url
+        return self.base_url + url[len(parts.scheme) + 3 + len(parts.netloc):]
+
+    def cached(self, url, params=None):
+        """Return the cached body of a url and when it was fetched, however old, or None"""
+        if self.cache is None:
+            return None
+        return self.cache.entry(self.full_url(url, params))
+
+    @staticmethod
+    def full_url(url, params=None):
+        return requests.Request('GET', url, params=params).prepare().url
+
+    @staticmethod
+    def cached_response(url, text):
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = text.encode('utf-8')
+        response.encoding = 'utf-8'
+        return response
+
+    def remember(self, url, response):
+        """Keep the validators of a response once its contents have been processed"""
+        if response.status_code != 200:
+            return
+        validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        if any(validators) and self.validators.get(url) != validators:
+            with self.lock:
+                self.validators[url] = validators
+                self.changed.add(url)
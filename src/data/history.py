@@ -0,0 +1,202 @@
+import os
+import struct
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# The tracked values and the factor they are stored with as integers. These are stats of the
+# game pages, which every refresh updates, unlike the ratings and votes of the search results.
+FIELDS = (('baverage', 1000), ('average', 1000), ('usersrated', 1), ('numplays', 1),
+          ('numplays_month', 1), ('numowned', 1), ('numwish', 1))
+# Bit i of known is set in the records of a game from the first one that observed field i
+RECORD = np.dtype([('gameid', '<i4'), ('second', '<u4'), ('known', 'u1')] +
+                  [(name, '<i4') for name, _ in FIELDS])
+EPOCH = datetime(1970, 1, 1)
+# Every file starts with the magic, the version and the record size; change the version with
+# the layout of RECORD or the meaning of FIELDS
+MAGIC = b'BGGHIST\0'
+VERSION = 2
+HEADER = MAGIC + struct.pack('<II', VERSION, RECORD.itemsize)
+
+
+def to_seconds(when):
+    return int((when - EPOCH).total_seconds())
+
+
+def to_datetime(seconds):
+    return pd.to_datetime(np.asarray(seconds, dtype='int64'), unit='s')
+
+
+class HistoryFormatError(Exception):
+    pass
+
+
+class HistoryStore:
+    """Append-only history of the ratings, votes and play counts of the games.
+
+    Every observation is a fixed size record of the gameid, the second it was made, the
+    bitmask of the fields observed so far and, per field, the change since the previous record
+    of the game; the first record of a game holds the values themselves. Values are stored as
+    scaled integers, a missing value counts as unchanged and an observation without any change
+    isn't stored. A field that was never observed is unknown, NaN in series and changes, and
+    not 0.
+
+    The records follow a header with the format version, and a file with another header is
+    refused rather than misread. The file is read into arrays grouped by game in time order,
+    so the values of a game are a cumulative sum over a contiguous range, and the change of
+    every game over a period is a single weighted bincount of the deltas in it.
+    """
+    def __init__(self, filename='data/processed/bgg.history'):
+        self.filename = filename
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        if len(data) < len(HEADER) and HEADER.startswith(data):
+            # a new file, or one cut off while its header was written; the first append
+            # writes it again
+            self.has_header = False
+            data = b''
+        elif data.startswith(HEADER):
+            self.has_header = True
+            data = data[len(HEADER):]
+            complete = len(data) - len(data) % RECORD.itemsize
+            if complete < len(data):
+                # a record cut off by a crash during an append, which the next one would follow
+                os.truncate(self.filename, len(HEADER) + complete)
+                data = data[:complete]
+        else:
+            raise HistoryFormatError("{} is not a history file of version {}{}".format(
+                self.filename, VERSION, self.found_version(data)))
+        self.raw = np.frombuffer(data, dtype=RECORD)
+        self.stale = True
+        self.refresh()
+
+    @staticmethod
+    def found_version(data):
+        if not data.startswith(MAGIC) or len(data) < len(HEADER):
+            return ''
+        version, record_size = struct.unpack_from('<II', data, len(MAGIC))
+        return ', it has version {} with records of {} bytes'.format(version, record_size)
+
+    def refresh(self):
+        """Group the records by game again if records were appended since the last time"""
+        if self.stale:
+            self.set_records(self.raw)
+            self.stale = False
+
+    def set_records(self, records):
+        order = np.argsort(records['gameid'], kind='stable')
+        self.records = records[order]
+        gameids = self.records['gameid']
+        self.starts = np.flatnonzero(np.r_[True, gameids[1:] != gameids[:-1]]) \
+            if len(gameids) else np.array([], dtype=int)
+        self.gameids = gameids[self.starts]
+        self.deltas = np.stack([self.records[name].astype(np.int64) for name, _ in FIELDS],
+                               axis=1) if len(gameids) else np.zeros((0, len(FIELDS)), np.int64)
+        totals = np.cumsum(self.deltas, axis=0)
+        group = np.repeat(np.arange(len(self.starts)),
+                          np.diff(np.r_[self.starts, len(gameids)]))
+        self.values = totals - (totals - self.deltas)[self.starts][group]
+        self.known = (self.records['known'][:, None] & (1 << np.arange(len(FIELDS)))) != 0
+        ends = np.r_[self.starts[1:], len(gameids)][:len(self.starts)] - 1
+        self.last = {gid: (second, values, known) for gid, second, values, known in
+                     zip(self.gameids.tolist(), self.records['second'][ends].tolist(),
+                         self.values[ends], self.records['known'][ends].tolist())}
+
+    @staticmethod
+    def encode(game):
+        """The scaled integer values of a game, with None for the missing ones"""
+        values = []
+        for name, scale in FIELDS:
+            try:
+                value = float(game.get(name))
+            except (TypeError, ValueError):
+                value = np.nan
+            values.append(None if np.isnan(value) else int(round(value * scale)))
+        return values
+
+    def append(self, observations):
+        """Append (gameid, when, game) observations, skipping the ones older than the last
+        one of their game and the ones without a change. An observation made at the same time
+        as the last one of its game replaces its values."""
+        records = []
+        for gameid, when, game in observations:
+            second = to_seconds(when)
+            last_second, last_values, last_known = self.last.get(
+                gameid, (None, np.zeros(len(FIELDS), int), 0))
+            if last_second is not None and second < last_second:
+                continue
+            encoded = self.encode(game)
+            values = [int(last) if value is None else value
+                      for value, last in zip(encoded, last_values)]
+            known = last_known | sum(1 << i for i, value in enumerate(encoded) if value is not None)
+            deltas = [value - int(last) for value, last in zip(values, last_values)]
+            if last_second is not None and known == last_known and not any(deltas):
+                continue
+            records.append((gameid, second, known) + tuple(deltas))
+            self.last[gameid] = (second, np.array(values), known)
+        if not records:
+            return 0
+        records = np.array(records, dtype=RECORD)
+        with open(self.filename, 'ab' if self.has_header else 'wb') as f:
+            if not self.has_header:
+                f.write(HEADER)
+            f.write(records.tobytes())
+        self.has_header = True
+        self.raw = np.concatenate([self.raw, records])
+        self.stale = True
+        return len(records)
+
+    def series(self, gameid, start=None, end=None):
+        """The observed values of a game between start and end, indexed by time"""
+        self.refresh()
+        pos = np.searchsorted(self.gameids, gameid)
+        if pos == len(self.gameids) or self.gameids[pos] != gameid:
+            return pd.DataFrame(columns=[name for name, _ in FIELDS])
+        first = self.starts[pos]
+        last = self.starts[pos + 1] if pos + 1 < len(self.starts) else len(self.records)
+        seconds = self.records['second'][first:last]
+        lo = first + np.searchsorted(seconds, to_seconds(start)) if start is not None else first
+        hi = first + np.searchsorted(seconds, to_seconds(end), side='right') \
+            if end is not None else last
+        frame = self.frame(self.values[lo:hi], self.known[lo:hi], self.records['second'][lo:hi])
+        return frame[~frame.index.duplicated(keep='last')]
+
+    @staticmethod
+    def frame(values, known, seconds):
+        scales = np.array([scale for _, scale in FIELDS], dtype=float)
+        return pd.DataFrame(np.where(known, values / scales, np.nan),
+                            columns=[name for name, _ in FIELDS],
+                            index=pd.Index(to_datetime(seconds), name='time'))
+
+    def changes(self, since, until=None):
+        """The change of every field of every game between its last observation up to since
+        and its last observation up to until (by default now), indexed by gameid.
+
+        Fields that weren't known at since, including all fields of the games first
+        observed after it, get NaN, as their change is unknown.
+        """
+        self.refresh()
+        seconds = self.records['second'].astype(np.int64)
+        in_period = seconds > to_seconds(since)
+        if until is not None:
+            in_period &= seconds <= to_seconds(until)
+        group = np.repeat(np.arange(len(self.starts)),
+                          np.diff(np.r_[self.starts, len(self.records)]))
+        scales = np.array([scale for _, scale in FIELDS], dtype=float)
+        changes = np.stack([np.bincount(group[in_period], weights=self.deltas[in_period, i],
+                                        minlength=len(self.starts))
+                            for i in range(len(FIELDS))], axis=1) / scales
+        # the fields known in the last record of every game up to since
+        before = np.bincount(group, weights=seconds <= to_seconds(since),
+                             minlength=len(self.starts)).astype(int)
+        known = self.known[np.maximum(self.starts + before - 1, 0)] & (before > 0)[:, None]
+        changes[~known] = np.nan
+        return pd.DataFrame(changes, columns=[name for name, _ in FIELDS],
+                            index=pd.Index(self.gameids, name='gameid'))
@@ -0,0 +1,71 @@
+import json
+import sqlite3
+from datetime import datetime, timedelta
+
+from src.data.database import DATE_FORMAT
+
+
+class CrawlJournal:
+    """Progress of the publisher crawl, so that an interrupted crawl can resume where it stopped.
+
+    It lives in two tables next to the games: crawl_publishers with the state of the latest
+    crawl of every publisher and crawl_pages with the games found on every finished page.
+    """
+    def __init__(self, filename='data/processed/bgg.db'):
+        self.filename = filename
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            conn.execute("create table if not exists crawl_publishers "
+                         "(publisher text primary key, started text, completed text, "
+                         "last_page integer, next_url text);")
+            conn.execute("create table if not exists crawl_pages "
+                         "(publisher text, page integer, url text, next_url text, gameids text, "
+                         "finished text, primary key (publisher, page));")
+        conn.close()
+
+    def resume(self, publisher, first_url, recrawl_after=7):
+        """Return the page number and url to continue the crawl of a publisher with, or None
+        when the publisher was completely crawled in the last recrawl_after days."""
+        conn = sqlite3.connect(self.filename)
+        try:
+            row = conn.execute("select completed, last_page, next_url from crawl_publishers "
+                               "where publisher = ?;", (publisher,)).fetchone()
+            if row is not None and row[0] is None and row[2] is not None:
+                return row[1] + 1, row[2]
+            if row is not None and row[0] is not None and \
+                    datetime.strptime(row[0], DATE_FORMAT) > \
+                    datetime.now() - timedelta(days=recrawl_after):
+                return None
+            with conn:
+                conn.execute("insert or replace into crawl_publishers "
+                             "(publisher, started, completed, last_page, next_url) "
+                             "values (?, ?, null, 0, ?);",
+                             (publisher, datetime.now().strftime(DATE_FORMAT), first_url))
+            return 1, first_url
+        finally:
+            conn.close()
+
+    def page(self, publisher, page):
+        """Return the url, next url and game ids of a page of an earlier crawl, or None"""
+        conn = sqlite3.connect(self.filename)
+        try:
+            row = conn.execute("select url, next_url, gameids from crawl_pages "
+                               "where publisher = ? and page = ?;", (publisher, page)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def record_page(self, publisher, page, url, next_url, gameids):
+        now = datetime.now().strftime(DATE_FORMAT)
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            conn.execute("insert or replace into crawl_pages "
+                         "(publisher, page, url, next_url, gameids, finished) "
+                         "values (?, ?, ?, ?, ?, ?);",
+                         (publisher, page, url, next_url, json.dumps(gameids), now))
+            conn.execute("update crawl_publishers set last_page = ?, next_url = ?, completed = ? "
+                         "where publisher = ?;",
+                         (page, next_url, None if next_url else now, publisher))
+        conn.close()
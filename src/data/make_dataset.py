@@ -4,6 +4,10 @@ import click
 import logging
 from dotenv import find_dotenv, load_dotenv
 
+from src.data.cache import ResponseCache
+from src.data.database import Database
+from src.data.scrape_data import BGGInterface
+
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
@@ -11,9 +15,15 @@ from dotenv import find_dotenv, load_dotenv
 def main(input_filepath, output_filepath):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
+
+        The raw data are the responses cached by the scraper, which are
+        parsed again into the games database without any requests.
     """
     logger = logging.getLogger(__name__)
     logger.info('making final data set from raw data')
+    db = Database(output_filepath, tag_storage='table')
+    bgg = BGGInterface(db, cache=ResponseCache(input_filepath))
+    bgg.reparse_from_cache()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,168 @@
+import json
+import os
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+# Upper bounds in seconds of the latency histogram buckets, from 1 ms to 2 minutes
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.,
+           60., 120.)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """The upper bound of the bucket holding the q-quantile, inf if it's beyond the last"""
+        rank, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank and seen > 0:
+                return bound
+        return float('nan')
+
+
+class Metrics:
+    """Counters and latency histograms of a run, by name and labels.
+
+    Nothing is recorded until enable is called; while disabled, count and observe return
+    right away and timer returns a shared do-nothing context manager, so instrumented code
+    runs at practically the same speed. The metrics can be written as a Prometheus text file
+    and as a JSON summary of the run.
+    """
+    def __init__(self, prefix='bgg'):
+        self.prefix = prefix
+        self.enabled = False
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def count(self, name, n=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def timer(self, name, **labels):
+        """Context manager that observes the seconds its block took in histogram name"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def metric_name(self, name, labels, suffix=''):
+        label_text = ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                              for key, value in labels)
+        name = '{}_{}{}'.format(self.prefix, name, suffix)
+        return '{}{{{}}}'.format(name, label_text) if label_text else name
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE {}_{} counter'.format(self.prefix, name))
+                typed.add(name)
+            lines.append('{} {}'.format(self.metric_name(name, labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append('# TYPE {}_{} histogram'.format(self.prefix, name))
+                typed.add(name)
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += n
+                lines.append('{} {}'.format(
+                    self.metric_name(name, labels + (('le', bound),), '_bucket'), cumulative))
+            lines.append('{} {}'.format(self.metric_name(name, labels, '_sum'), histogram.sum))
+            lines.append('{} {}'.format(self.metric_name(name, labels, '_count'), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': h.count,
+                           'seconds': h.sum, 'mean': h.sum / h.count if h.count else None,
+                           'p50': h.quantile(.5), 'p95': h.quantile(.95), 'p99': h.quantile(.99)}
+                          for (name, labels), h in sorted(self.histograms.items(),
+                                                          key=lambda item: item[0])]
+        return {'counters': counters, 'histograms': histograms}
+
+    def write(self, directory, name='metrics'):
+        """Write the metrics to <name>.prom and <name>.json in directory, each replaced at once
+        so that a Prometheus textfile collector never reads half a file"""
+        os.makedirs(directory, exist_ok=True)
+        for extension, text in [('.prom', self.prometheus_text()),
+                                ('.json', json.dumps(self.summary(), indent=2, default=str))]:
+            filename = os.path.join(directory, name + extension)
+            with open(filename + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(filename + '.tmp', filename)
+
+
+def timed(func, *args, **kwargs):
+    """Return the result of func and the seconds it took, e.g. to observe the time spent in
+    another process"""
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    return result, perf_counter() - start
+
+
+METRICS = Metrics()
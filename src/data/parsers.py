@@ -0,0 +1,97 @@
+import json
+import re
+from datetime import datetime
+
+import lxml.html
+import numpy as np
+
+PRELOAD_MARKER = 'geekitemPreload'
+BGG_URL = "http://www.boardgamegeek.com"
+
+
+class PreloadNotFoundError(AttributeError):
+    """Raised when a game page has no geekitemPreload payload, e.g. because it was cut off.
+
+    It subclasses AttributeError so that the retry logic treats it like the failed regex
+    match it replaces.
+    """
+    pass
+
+
+def _null_to_nan(pairs):
+    obj = {}
+    for key, value in pairs:
+        if value is None:
+            value = np.nan
+        elif isinstance(value, list):
+            value = [np.nan if ele is None else ele for ele in value]
+        obj[key] = value
+    return obj
+
+
+_decoder = json.JSONDecoder(object_pairs_hook=_null_to_nan)
+
+
+def extract_geekitem_preload(pagetext):
+    """Decode the geekitemPreload object of a game page, with null mapped to NaN"""
+    marker = pagetext.find(PRELOAD_MARKER)
+    if marker < 0:
+        raise PreloadNotFoundError("No {} found in the page".format(PRELOAD_MARKER))
+    start = pagetext.find('{', pagetext.find('=', marker))
+    if start < 0:
+        raise PreloadNotFoundError("No {} object found in the page".format(PRELOAD_MARKER))
+    try:
+        gameinfo_dict, _ = _decoder.raw_decode(pagetext, start)
+    except ValueError as e:
+        raise PreloadNotFoundError("Could not decode {}: {}".format(PRELOAD_MARKER, e))
+    return gameinfo_dict
+
+
+def parse_listing(pagetext, publisher):
+    """Return the games on a search results page and the url of the next page, if any.
+
+    The page is parsed by lxml and each row of the collection table is read in a single pass
+    over its cells, giving the same dicts as the BeautifulSoup parser it replaced, which is
+    kept in src.benchmarks.listing.
+    """
+    root = lxml.html.fromstring(pagetext)
+    games = [_listing_row(row, publisher)
+             for row in root.xpath('//div[@id="collection"]//tr[@id="row_"]')]
+    next_page = root.xpath('//a[@title="next page"]/@href')
+    next_url = "https://boardgamegeek.com" + next_page[0] if next_page else None
+    return games, next_url
+
+
+def _listing_row(row, publisher):
+    rank_cell, name_link, year_span, ratings = None, None, None, []
+    for cell in row.iterchildren('td'):
+        # like BeautifulSoup, match any of the whitespace separated classes
+        classes = (cell.get('class') or '').split()
+        if 'collection_rank' in classes:
+            rank_cell = cell
+        elif 'collection_objectname' in classes:
+            name_link = next(cell.iter('a'), None)
+            year_span = next(cell.iter('span'), None)
+        elif 'collection_bggrating' in classes:
+            ratings.append(cell.text)
+    game = {}
+    rank_link = next(rank_cell.iter('a'), None)
+    game['rank'] = int(rank_link.get('name')) if rank_link is not None else 999999
+    game['title'] = name_link.text
+    game['url'] = BGG_URL + name_link.get('href')
+    game['gameid'] = int(re.search(r'\/(\d*)\/', name_link.get('href')).group(1))
+    year = re.search(r'\((\d*)\)', year_span.text) if year_span is not None else None
+    game['year'] = int(year.group(1)) if year is not None else 1900
+    game['bggrating'] = _rating(ratings[0], float, None)
+    game['avgrating'] = _rating(ratings[1], float, None)
+    game['votes'] = _rating(ratings[2], int, 0)
+    game['publisher'] = publisher
+    game['updated'] = datetime(2000, 1, 1)
+    return game
+
+
+def _rating(text, kind, default):
+    try:
+        return kind(text)
+    except ValueError:
+        return default
@@ -0,0 +1,124 @@
+import heapq
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from itertools import count
+from time import monotonic, strftime
+
+import requests
+from boardgamegeek import BoardGameGeekAPIError
+
+from src.data.metrics import METRICS
+
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+PARSE = 'parse'
+PERMANENT = 'permanent'
+
+
+def classify_failure(exception):
+    """Return the kind of a failure and the seconds the server asked us to wait, if any.
+
+    The kind is THROTTLED for 429 and 503 responses, TRANSIENT for other server and
+    connection errors, PARSE when a page could not be parsed and PERMANENT for other
+    client errors. Other exceptions are bugs, for which the kind is None.
+    """
+    if isinstance(exception, requests.HTTPError) and exception.response is not None:
+        status = exception.response.status_code
+        if status in (429, 503):
+            return THROTTLED, retry_after(exception.response)
+        if status >= 500:
+            return TRANSIENT, retry_after(exception.response)
+        return PERMANENT, None
+    if isinstance(exception, (requests.ConnectionError, requests.Timeout, BoardGameGeekAPIError)):
+        return TRANSIENT, None
+    if isinstance(exception, (AttributeError, KeyError, ValueError)):
+        return PARSE, None
+    return None, None
+
+
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryScheduler:
+    """Work queue of (gameid, ...) jobs that puts failed jobs back at the end of the queue.
+
+    New jobs are taken from the jobs iterator, after the jobs added by add. A failed job is retried after the delay the
+    server asked for or an exponential backoff, while the other jobs keep flowing. Throttling
+    also slows down the shared rate limiter. Jobs are dropped after max_attempts failures,
+    or max_parse_attempts when the page could not be parsed.
+    """
+    def __init__(self, jobs, rate_limiter=None, max_attempts=5, max_parse_attempts=2,
+                 backoff=30., max_backoff=600.):
+        self.jobs = iter(jobs)
+        self.added = deque()
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+        self.max_parse_attempts = max_parse_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = []
+        self.attempts = {}
+        self.order = count()
+        self.exhausted = False
+
+    def next_job(self):
+        """Return the next job that can run now, or None if there is none (yet)"""
+        if self.retries and self.retries[0][0] <= monotonic():
+            return heapq.heappop(self.retries)[2]
+        if self.added:
+            return self.added.popleft()
+        if not self.exhausted:
+            try:
+                return next(self.jobs)
+            except StopIteration:
+                self.exhausted = True
+        return None
+
+    def add(self, jobs):
+        """Queue jobs that came out of another job, e.g. the games of a batch"""
+        self.added.extend(jobs)
+
+    def finished(self):
+        return self.exhausted and not self.retries and not self.added
+
+    def seconds_until_next_retry(self):
+        return max(0., self.retries[0][0] - monotonic()) if self.retries else 0.
+
+    def succeeded(self, job):
+        self.attempts.pop(job[0], None)
+        if self.rate_limiter is not None:
+            self.rate_limiter.succeeded()
+
+    def failed(self, job, exception):
+        kind, delay = classify_failure(exception)
+        if kind is None:
+            raise exception
+        METRICS.count('failures_total', kind=kind)
+        gid = job[0]
+        attempts = self.attempts.get(gid, 0) + 1
+        self.attempts[gid] = attempts
+        print("             {} - Game id {} failed ({}): {}"
+              .format(strftime('%d %b, %H:%M:%S'), gid, kind, exception))
+        if kind == THROTTLED and self.rate_limiter is not None:
+            self.rate_limiter.throttled(delay)
+        max_attempts = self.max_parse_attempts if kind == PARSE else self.max_attempts
+        if kind == PERMANENT or attempts >= max_attempts:
+            print("             Giving up on game id {} after {} attempts".format(gid, attempts))
+            METRICS.count('games_given_up_total')
+            self.attempts.pop(gid)
+            return
+        if delay is None:
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        heapq.heappush(self.retries, (monotonic() + delay, next(self.order), job))
@@ -1,37 +1,68 @@
 import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from itertools import islice
+from queue import Queue
 from time import time, sleep
 
 import numpy as np
-import requests
 from boardgamegeek import BoardGameGeek
-from bs4 import BeautifulSoup
-from retrying import retry
 from tqdm import tqdm
 
-from src.data.utils import retry_if_attribute_error
+from src.data.fetch import Fetcher
+from src.data.journal import CrawlJournal
+from src.data.metrics import METRICS, timed
+from src.data.parsers import extract_geekitem_preload, parse_listing
+from src.data.scheduler import RetryScheduler
+from src.data.utils import RateLimiter, AdaptiveRateLimiter
+from src.data.xmlapi import fetch_things, parse_things, THING_URL
+
+
+SEARCH_URL = "https://boardgamegeek.com/search/boardgame/page/"
 
 
 class BGGGame:
-    def __init__(self, gamedict, gid, bgg):
+    def __init__(self, gamedict, gid, bgg, rate_limiter=None, fetcher=None):
         self.gid = gid
         self.bgg = bgg
         self.gamedict = gamedict
+        self.rate_limiter = rate_limiter
+        self.fetcher = fetcher
+
+    def wait_for_turn(self):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+
+    def update_gamedata(self, thing=None):
+        response = self.fetch_page()
+        if response is not None:
+            self.parse_gamedata(response.text, thing=thing)
+            self.fetcher.remember(self.gamedict['url'], response)
+
+    def fetch_page(self):
+        """Return the response with the page of the game, or None if it didn't change"""
+        if self.fetcher is None:
+            self.fetcher = Fetcher()
+        self.wait_for_turn()
+        response = self.fetcher.get(self.gamedict['url'])
+        response.raise_for_status()
+        if response.status_code == 304:
+            self.gamedict['updated'] = datetime.now()
+            return None
+        return response
+
+    def parse_gamedata(self, pagetext, thing=None):
+        with METRICS.timer('parse_seconds', page='game'):
+            gameinfo_dict = extract_geekitem_preload(pagetext)
+            self.process_gameinfo(gameinfo_dict, thing=thing)
 
-    @retry(wait_exponential_multiplier=500, wait_exponential_max=600000, stop_max_delay=600000,
-           retry_on_exception=retry_if_attribute_error)
-    def update_gamedata(self):
-        url = self.gamedict['url']
-        pagetext = requests.get(url)
-        soup = BeautifulSoup(pagetext.text, "html.parser")
-        gameinfo = re.search('geekitemPreload = (\{.*\}\});', soup.find("script").contents[0]).group(1)
-        gameinfo_dict = eval(gameinfo.replace("true", "True")
-                                     .replace("false", "False")
-                                     .replace("null", "np.nan"))
-        self.process_gameinfo(gameinfo_dict)
-
-    def process_gameinfo(self, gameinfo_dict):
-        g = self.bgg.game(game_id=self.gid)
+    def process_gameinfo(self, gameinfo_dict, thing=None):
+        if thing is not None:
+            g = thing
+        else:
+            self.wait_for_turn()
+            with METRICS.timer('api_seconds', call='game'):
+                g = self.bgg.game(game_id=self.gid)
         self.gamedict['description'] = g.description
         self.gamedict['minage'] = g.min_age
         self.gamedict['minplayers'] = g.min_players
@@ -107,49 +138,20 @@ class BGGGame:
         self.gamedict.update(categories)
         self.gamedict['updated'] = datetime.now()
 
-    @staticmethod
-    def new_game(gamesoup, publisher):
-        game = {}
-        try:
-            game['rank'] = int(gamesoup.find("td", attrs={"class": "collection_rank"})
-                                       .find("a")['name'])
-        except TypeError:
-            game['rank'] = 999999
-        game['title'] = gamesoup.find("td", {"class": "collection_objectname"})\
-                                .find("a").contents[0]
-        game['url'] = "http://www.boardgamegeek.com" + \
-                      gamesoup.find("td", {"class": "collection_objectname"}).find("a")['href']
-        game['gameid'] = int(re.search(r'\/(\d*)\/',
-                                       gamesoup.find("td", {"class": "collection_objectname"})
-                                               .find("a")['href']).group(1))
-        try:
-            game['year'] = int(re.search('\((\d*)\)',
-                                         gamesoup.find("td", {"class": "collection_objectname"})
-                                                 .find("span").contents[0]).group(1))
-        except AttributeError:
-            game['year'] = 1900
-        ratings = gamesoup.find_all("td", {"class": "collection_bggrating"})
-        try:
-            game['bggrating'] = float(ratings[0].contents[0])
-        except ValueError:
-            game['bggrating'] = None
-        try:
-            game['avgrating'] = float(ratings[1].contents[0])
-        except ValueError:
-            game['avgrating'] = None
-        try:
-            game['votes'] = int(ratings[2].contents[0])
-        except ValueError:
-            game['votes'] = 0
-        game['publisher'] = publisher
-        game['updated'] = datetime(2000, 1, 1)
-        return game
+
+def parse_game(gamedict, gid, pagetext, thing):
+    """Parse the fetched page of a game into its gamedict, in a process of a parsing pool"""
+    game = BGGGame(gamedict, gid, None)
+    game.parse_gamedata(pagetext, thing=thing)
+    return game.gamedict
 
 
 class BGGInterface:
-    def __init__(self, db):
+    def __init__(self, db, cache=None, base_url=None):
+        """base_url sends the requests to another server than boardgamegeek.com, see Fetcher"""
         self.db = db
         self.bgg = BoardGameGeek()
+        self.fetcher = Fetcher(db.filename, cache=cache, base_url=base_url)
         self.publishers = {
                 "999 Games": "&include%5Bpublisherid%5D=267",
                 "Asmodee": "&include%5Bpublisherid%5D=157",
@@ -182,56 +184,266 @@ class BGGInterface:
                 "Z-Man Games": "&include%5Bpublisherid%5D=538"
             }
 
-    def add_new_games(self):
-        for k, v in tqdm(self.publishers.items(), total=len(self.publishers.keys())):
-            self.get_games_of_publisher(k, v)
-        self.save_data()
+    def add_new_games(self, recrawl_after=7, workers=1, requests_per_second=1.):
+        journal = CrawlJournal(self.db.filename)
+        rate_limiter = RateLimiter(requests_per_second)
+        if workers > 1:
+            pages = self.crawl_concurrently(workers, journal, recrawl_after, rate_limiter)
+        else:
+            pages = (page for k, v in tqdm(self.publishers.items(),
+                                           total=len(self.publishers.keys()))
+                     for page in self.crawl_publisher(k, v, journal, recrawl_after, rate_limiter))
+        for page in pages:
+            self.store_page(journal, *page)
+        self.save_data(snapshot=True)
+
+    def get_games_of_publisher(self, publisher, query, sleeptime=1, journal=None, recrawl_after=7,
+                               rate_limiter=None):
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(1. / sleeptime)
+        for page in self.crawl_publisher(publisher, query, journal, recrawl_after, rate_limiter):
+            self.store_page(journal, *page)
+        print('')
 
-    def get_games_of_publisher(self, publisher, query, sleeptime=1):
+    def crawl_publisher(self, publisher, query, journal=None, recrawl_after=7, rate_limiter=None):
+        """Yield the games on every search results page of a publisher, together with the
+        publisher, page number, url and next url. An unfinished crawl in the journal is resumed."""
+        page = 1
+        url = SEARCH_URL + "1?sort=rank&advsearch=1" + query
+        if journal is not None:
+            resume = journal.resume(publisher, url, recrawl_after=recrawl_after)
+            if resume is None:
+                print('Skipping {}, which was crawled in the last {} days'
+                      .format(publisher, recrawl_after))
+                return
+            page, url = resume
         print('Processing games by {}'.format(publisher))
-        more_games_available = True
-        url = "https://boardgamegeek.com/search/boardgame/page/1?sort=rank&advsearch=1" + query
-        while more_games_available:
-            pagetext = requests.get(url)
+        while url:
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            response = self.fetcher.get(url, conditional=journal is not None)
             print(url)
-            sleep(sleeptime)
-            soup = BeautifulSoup(pagetext.text, "html.parser")
-            if len(soup.find("div", attrs={"id": "collection"})
-                       .find_all("tr", attrs={"id": "row_"})) > 0:
-                for gamesoup in soup.find("div", attrs={"id": "collection"}) \
-                                    .find_all("tr", attrs={"id": "row_"}):
-                    game = BGGGame.new_game(gamesoup, publisher)
-                    self.db.set_game(game, overwrite=False)
+            known = journal.page(publisher, page) if response.status_code == 304 else None
+            if known is not None and known[0] == url:
+                # The page didn't change, so its games and next page are still in the journal
+                next_url = known[1]
+                games = [self.db.games[gid] for gid in known[2] if gid in self.db.games]
+            else:
+                if response.status_code == 304:
+                    response = self.fetcher.get(url, conditional=False)
+                games, next_url = self.parse_listing(response.text, publisher)
+            METRICS.count('search_pages_total', status=response.status_code)
+            yield publisher, page, url, next_url, games
+            self.fetcher.remember(url, response)
+            url = next_url
+            page += 1
+
+    @staticmethod
+    def parse_listing(pagetext, publisher):
+        """Return the games on a search results page and the url of the next page, if any"""
+        with METRICS.timer('parse_seconds', page='search'):
+            return parse_listing(pagetext, publisher)
+
+    def store_page(self, journal, publisher, page, url, next_url, games):
+        for game in games:
+            self.db.set_game(game, overwrite=False)
+        if journal is not None:
+            self.save_data()
+            journal.record_page(publisher, page, url, next_url,
+                                [game['gameid'] for game in games])
+
+    def crawl_concurrently(self, workers, journal=None, recrawl_after=7, rate_limiter=None):
+        """Crawl several publishers at once on a pool of threads sharing rate_limiter, and yield
+        their pages as they come in. Storing the pages is left to the calling thread."""
+        pages = Queue()
+
+        def crawl(publisher, query):
             try:
-                url = "https://boardgamegeek.com" + soup.find("a", {"title": "next page"})['href']
-            except TypeError:
-                more_games_available = False
-        print('')
+                for page in self.crawl_publisher(publisher, query, journal, recrawl_after,
+                                                 rate_limiter):
+                    pages.put(page)
+            finally:
+                pages.put(None)
 
-    def save_data(self):
-        self.db.close()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(crawl, k, v) for k, v in self.publishers.items()]
+            progress = tqdm(total=len(futures))
+            while progress.n < len(futures):
+                page = pages.get()
+                if page is None:
+                    progress.update()
+                else:
+                    yield page
+            progress.close()
+            for future in futures:
+                future.result()
 
-    def update_all_game_details(self, freshness=60, save_every=120):
-        gameids = self.db.get_gameids_by(col='rank')
+    def save_data(self, snapshot=False):
+        self.db.close(snapshot=snapshot)
+        self.fetcher.save()
+
+    def update_all_game_details(self, freshness=60, save_every=120, workers=1,
+                                requests_per_second=4., api_batch_size=20, parse_workers=0):
+        rate_limiter = AdaptiveRateLimiter(requests_per_second)
+        jobs = self.thing_batches(self.db.stale_gameids(freshness), api_batch_size)
         t0 = time()
-        for gid in tqdm(gameids):
-            if 'updated' in self.db.games[gid]:
-                try:
-                    if (datetime.now() - self.db.games[gid]['updated']).days <= freshness:
-                        continue
-                except AttributeError:
-                    pass
-            try:
-                print('{:>6} - {:>6} - {}'.format(gid, self.db.games[gid]['rank'],
-                                                  self.db.games[gid]['url']))
-            except:
-                print("Couldn't print the game title for some reason")
-            game = BGGGame(self.db.games[gid], gid, self.bgg)
-            game.update_gamedata()
-            self.db.set_game(game.gamedict, overwrite=True)
+        for gamedict in tqdm(self.refresh_games(jobs, workers, rate_limiter, parse_workers)):
+            self.db.set_game(gamedict, overwrite=True)
+            METRICS.count('games_refreshed_total')
             t1 = time()
             if t1 - t0 >= save_every:
                 self.save_data()
                 t0 = time()
-        self.save_data()
+        self.save_data(snapshot=True)
+
+    @staticmethod
+    def thing_batches(gameids, batch_size):
+        """Group the game ids lazily in jobs of batch_size games, whose XML API info is fetched
+        in a single thing request by refresh_games"""
+        gameids = iter(gameids)
+        batch = tuple(islice(gameids, batch_size))
+        while batch:
+            yield batch, None
+            batch = tuple(islice(gameids, batch_size))
+
+    def fetch_things(self, gameids, rate_limiter=None):
+        return fetch_things(gameids, rate_limiter=rate_limiter, fetcher=self.fetcher)
+
+    def refresh_game(self, gid, thing=None, rate_limiter=None):
+        game = self.game_to_refresh(gid, rate_limiter)
+        game.update_gamedata(thing=thing)
+        return game.gamedict
+
+    def fetch_game(self, gid, thing=None, rate_limiter=None):
+        """Fetch the page of a game to be parsed by parse_game. Returns the gamedict and the
+        response, which is None if the page didn't change."""
+        game = self.game_to_refresh(gid, rate_limiter)
+        return game.gamedict, game.fetch_page()
+
+    def game_to_refresh(self, gid, rate_limiter=None):
+        gamedict = self.db.game_with_tags(gid)
+        try:
+            print('{:>6} - {:>6} - {}'.format(gid, gamedict['rank'], gamedict['url']))
+        except:
+            print("Couldn't print the game title for some reason")
+        return BGGGame(gamedict, gid, self.bgg, rate_limiter=rate_limiter, fetcher=self.fetcher)
+
+    def refresh_games(self, jobs, workers=1, rate_limiter=None, parse_workers=0, max_queued=None):
+        """Refresh games on a pool of threads and yield each gamedict as soon as it is done.
+
+        A job is either a (gameid, thing) pair or a (gameids, None) batch from thing_batches,
+        whose thing request runs on the pool too and queues a pair per game when it is done.
+        Failed games and batches are put back in the queue by a RetryScheduler instead of
+        holding up the others. Writing the results to the database is left to the calling thread.
+        With parse_workers processes, the threads only fetch the pages and the parsing is done
+        by the process pool. At most max_queued fetched pages wait to be parsed; until there
+        is room again no new pages are fetched, so the memory use stays flat.
+        """
+        scheduler = RetryScheduler(jobs, rate_limiter=rate_limiter)
+        max_queued = max_queued or 4 * max(parse_workers, 1)
+        parser = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers else None
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = {}
+                fetching = 0
+                while True:
+                    room = min(2 * workers - fetching, max_queued - (len(pending) - fetching))
+                    fetching += self.submit_jobs(scheduler, room, executor, parser, pending,
+                                                 rate_limiter)
+                    if not pending:
+                        if scheduler.finished():
+                            break
+                        sleep(scheduler.seconds_until_next_retry())
+                        continue
+                    done, _ = wait(pending, timeout=scheduler.seconds_until_next_retry() or None,
+                                   return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job, stage, response = pending.pop(future)
+                        if stage != 'parse':
+                            fetching -= 1
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            scheduler.failed(job, e)
+                            continue
+                        gamedict = self.completed(stage, job, result, response, parser, pending,
+                                                  scheduler)
+                        if gamedict is not None:
+                            scheduler.succeeded(job)
+                            yield gamedict
+        finally:
+            if parser is not None:
+                parser.shutdown(cancel_futures=True)
 
+    def submit_jobs(self, scheduler, room, executor, parser, pending, rate_limiter=None):
+        """Submit up to room jobs of the scheduler to the thread pool, adding their futures to
+        pending. Returns the number of submitted jobs."""
+        submitted = 0
+        while submitted < room:
+            job = scheduler.next_job()
+            if job is None:
+                break
+            gid, thing = job
+            if isinstance(gid, tuple):
+                future = executor.submit(self.fetch_things, gid, rate_limiter=rate_limiter)
+                pending[future] = (job, 'things', None)
+            # without its thing a game can't be parsed in another process
+            elif parser is not None and thing is not None:
+                future = executor.submit(self.fetch_game, gid, thing, rate_limiter=rate_limiter)
+                pending[future] = (job, 'fetch', None)
+            else:
+                future = executor.submit(self.refresh_game, gid, thing, rate_limiter=rate_limiter)
+                pending[future] = (job, 'refresh', None)
+            submitted += 1
+        return submitted
+
+    def completed(self, stage, job, result, response, parser, pending, scheduler):
+        """Handle the result of a finished thing request, fetch, parse or refresh of a job.
+        Returns the gamedict of the game, or None if the job led to new ones: the games of a
+        batch queued with their things, or a fetched page submitted to the parser."""
+        if stage == 'things':
+            # a game missing from the response falls back to its own API call
+            scheduler.add((gid, result.get(gid)) for gid in job[0])
+            scheduler.succeeded(job)
+            return None
+        if stage == 'fetch':
+            gamedict, response = result
+            if response is None:
+                return gamedict
+            future = parser.submit(timed, parse_game, gamedict, job[0], response.text, job[1])
+            pending[future] = (job, 'parse', response)
+            return None
+        if stage == 'parse':
+            # timed in the parser process, whose own metrics are lost
+            gamedict, seconds = result
+            METRICS.observe('parse_seconds', seconds, page='game')
+            self.fetcher.remember(gamedict['url'], response)
+            return gamedict
+        return result
+
+    def reparse_from_cache(self):
+        """Rebuild the games from the responses in the cache, without making any requests"""
+        cache = self.fetcher.cache
+        publishers = {query: publisher for publisher, query in self.publishers.items()}
+        for url in tqdm(cache.urls(SEARCH_URL)):
+            query = re.search(r'&include%5Bpublisherid%5D=\d+', url)
+            if query is not None and query.group(0) in publishers:
+                games, _ = self.parse_listing(cache.entry(url)[0], publishers[query.group(0)])
+                for game in games:
+                    self.db.set_game(game, overwrite=False)
+        things = {}
+        for url in cache.urls(THING_URL):
+            things.update(parse_things(cache.entry(url)[0]))
+        for gid in tqdm(list(self.db.games)):
+            entry = self.fetcher.cached(self.db.games[gid]['url'])
+            if entry is None or gid not in things:
+                continue
+            game = BGGGame(self.db.game_with_tags(gid), gid, self.bgg, fetcher=self.fetcher)
+            try:
+                game.parse_gamedata(entry[0], thing=things[gid])
+            except AttributeError:
+                print("Couldn't parse the cached page of game id {}".format(gid))
+                continue
+            game.gamedict['updated'] = entry[1]
+            self.db.set_game(game.gamedict, overwrite=True)
+        self.save_data(snapshot=True)
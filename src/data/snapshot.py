@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+try:
+    import pyarrow as pa
+    from pyarrow import ipc
+except ImportError:
+    pa = None
+
+
+def available():
+    return pa is not None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Snapshots of the games need pyarrow, install it with 'pip install pyarrow'")
+
+
+def _column(values):
+    try:
+        return pa.array(values, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # a column with mixed types, e.g. numbers and text, is stored as text
+        return pa.array([None if value is None else str(value) for value in values],
+                        type=pa.string())
+
+
+def _tag_column(tag_lists):
+    """A list<dictionary<int32, string>> column, with the tags sorted in the dictionary"""
+    vocabulary = sorted({tag for tags in tag_lists for tag in tags})
+    index = {tag: idx for idx, tag in enumerate(vocabulary)}
+    offsets = np.zeros(len(tag_lists) + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum([len(tags) for tags in tag_lists])
+    indices = pa.array([index[tag] for tags in tag_lists for tag in tags], type=pa.int32())
+    values = pa.DictionaryArray.from_arrays(indices, pa.array(vocabulary, type=pa.string()))
+    return pa.ListArray.from_arrays(pa.array(offsets), values)
+
+
+def write_snapshot(filename, df, tags):
+    """Write the games DataFrame and their tags as an Arrow IPC file. tags maps every kind of
+    tags to the lists of tags of the games in df, which are stored in a column named kind.
+
+    The file is uncompressed so that readers can memory-map it, and it replaces the previous
+    snapshot at once; readers that still have that one mapped keep reading it.
+    """
+    _require_pyarrow()
+    gameids = list(df.index)
+    arrays, names = [_column(gameids)], ['gameid']
+    for col in df.columns:
+        if col != 'gameid':
+            arrays.append(_column(df[col].tolist()))
+            names.append(col)
+    for kind, tag_lists in tags.items():
+        arrays.append(_tag_column(tag_lists))
+        names.append(kind)
+    table = pa.Table.from_arrays(arrays, names=names)
+    with pa.OSFile(filename + '.tmp', 'wb') as sink:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=max(1, len(table)))
+    os.replace(filename + '.tmp', filename)
+
+
+class Snapshot:
+    """Memory-mapped snapshot of the games written by Database.
+
+    Opening it only reads the schema and the locations of the columns; a column is read from
+    the mapped file when it is used, and numeric columns without missing values are not even
+    copied. df and tag_matrix are drop-in replacements for Database.df and tag_matrix, e.g.
+    FeatureGenerator(snapshot.df(), tag_matrix=snapshot.tag_matrix).
+    """
+    def __init__(self, filename='data/processed/bgg.arrow'):
+        _require_pyarrow()
+        self.filename = filename
+        self.source = pa.memory_map(filename, 'r')
+        self.table = ipc.open_file(self.source).read_all()
+        self.gameids = self.table.column('gameid').to_numpy()
+
+    @property
+    def columns(self):
+        return [field.name for field in self.table.schema
+                if not pa.types.is_list(field.type)]
+
+    def df(self, columns=None):
+        """The games indexed by gameid, with only the given columns if any"""
+        columns = self.columns if columns is None else list(columns)
+        df = self.table.select(columns).to_pandas()
+        df.index = self.gameids
+        df.index.name = 'gameid'
+        return df
+
+    def tags(self, kind):
+        """The sorted vocabulary of a kind of tags and, per game, the offsets of its tag
+        indices into the vocabulary"""
+        tags = self.table.column(kind).combine_chunks()
+        values = tags.values
+        offsets = tags.offsets.to_numpy()
+        return values.dictionary.to_pylist(), offsets, values.indices.to_numpy()
+
+    def tag_matrix(self, kind, gameids=None):
+        """The one-hot CSR matrix of a kind of tags with a row per game in gameids, by default
+        all games, and its column names, as Database.tag_matrix"""
+        vocabulary, offsets, indices = self.tags(kind)
+        matrix = csr_matrix((np.ones(len(indices)), indices, offsets),
+                            shape=(len(self.gameids), len(vocabulary)))
+        if gameids is not None:
+            position = {gid: pos for pos, gid in enumerate(self.gameids)}
+            matrix = matrix[[position[gid] for gid in gameids]]
+        return matrix, [kind + '-' + tag for tag in vocabulary]
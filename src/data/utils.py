@@ -1,14 +1,54 @@
-from time import strftime
+from threading import Lock
+from time import monotonic, sleep
 
-from boardgamegeek import BoardGameGeekAPIError
+from src.data.metrics import METRICS
 
 
-def retry_if_attribute_error(exception):
-    """Return True if we should retry (in this case when it's an IOError), False otherwise"""
-    print("             {} - URL timed out, so I'm going to retry."
-          .format(strftime('%d %b, %H:%M:%S')))
-    if isinstance(exception, AttributeError) or isinstance(exception, BoardGameGeekAPIError):
-        return True
-    else:
-        print("             Encountered a new error: {}".format(exception))
-        return False
+class RateLimiter:
+    """Token bucket that can be shared between threads to cap the global request rate"""
+    def __init__(self, requests_per_second=1., burst=1):
+        self.rate = requests_per_second
+        self.capacity = burst
+        self.tokens = burst
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            delay = max(0., (1 - self.tokens) / self.rate)
+            self.tokens -= 1
+        if delay > 0:
+            sleep(delay)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """RateLimiter that halves its rate whenever the server throttles us and then slowly
+    climbs back to requests_per_second with every successful request."""
+    def __init__(self, requests_per_second=1., burst=1, min_rate=0.05, recovery=0.02):
+        super().__init__(requests_per_second, burst)
+        self.max_rate = requests_per_second
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.paused_until = monotonic()
+
+    def wait(self):
+        delay = self.paused_until - monotonic()
+        if delay > 0:
+            sleep(delay)
+        super().wait()
+
+    def throttled(self, retry_after=None):
+        METRICS.count('throttled_total')
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, monotonic() + retry_after)
+        print("             Throttled by the server, slowing down to {:.2f} requests per second"
+              .format(self.rate))
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.recovery)
@@ -0,0 +1,56 @@
+import html
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+
+import requests
+from boardgamegeek import BoardGameGeekAPIError
+
+from src.data.metrics import METRICS
+
+THING_URL = "https://boardgamegeek.com/xmlapi2/thing"
+
+# The fields of boardgamegeek's BoardGame that BGGGame.process_gameinfo relies on
+Thing = namedtuple('Thing', ['description', 'min_age', 'min_players', 'max_players',
+                             'categories', 'mechanics'])
+
+
+def fetch_things(gameids, rate_limiter=None, url=THING_URL, fetcher=None):
+    """Fetch the XML API info of several games in a single thing request"""
+    if rate_limiter is not None:
+        rate_limiter.wait()
+    params = {'id': ','.join(str(gid) for gid in gameids)}
+    with METRICS.timer('api_seconds', call='thing'):
+        if fetcher is not None:
+            response = fetcher.get(url, params=params, conditional=False)
+        else:
+            response = requests.get(url, params=params)
+    response.raise_for_status()
+    if response.status_code != 200:
+        raise BoardGameGeekAPIError("thing request returned status {}"
+                                    .format(response.status_code))
+    return parse_things(response.text)
+
+
+def parse_things(xml_text):
+    try:
+        root = ElementTree.fromstring(xml_text)
+    except ElementTree.ParseError as e:
+        raise BoardGameGeekAPIError("thing request returned invalid XML: {}".format(e))
+    things = {}
+    for item in root.findall('item'):
+        description = item.findtext('description')
+        things[int(item.get('id'))] = Thing(
+            description=html.unescape(description) if description is not None else None,
+            min_age=_int_value(item, 'minage'),
+            min_players=_int_value(item, 'minplayers'),
+            max_players=_int_value(item, 'maxplayers'),
+            categories=[link.get('value') for link in item.findall("link[@type='boardgamecategory']")],
+            mechanics=[link.get('value') for link in item.findall("link[@type='boardgamemechanic']")])
+    return things
+
+
+def _int_value(item, tag):
+    try:
+        return int(item.find(tag).get('value'))
+    except (AttributeError, TypeError, ValueError):
+        return None
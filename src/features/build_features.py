@@ -1,78 +1,295 @@
+import hashlib
+import os
+import pickle
 import re
 from collections import Counter
-from datetime import date
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date, datetime, timedelta
 
 import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
 from sklearn.cluster import KMeans
 import operator
 from tqdm import tqdm
 
+from src.data.metrics import METRICS
+
+
+SCORES = {}
+
+
+def register_score(column):
+    """Register a vectorized scoring function, which computes a column from the games DataFrame"""
+    def register(func):
+        SCORES[column] = func
+        return func
+    return register
+
+
+def _numeric(series):
+    return pd.to_numeric(series, errors='coerce').astype(float)
+
+
+@register_score('final_score')
+def final_score(df):
+    years_since_publishing = date.today().year - _numeric(df['year']) + 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lasting_popularity = np.log10(
+            _numeric(df['numplays_month']) +
+            _numeric(df['numplays']) / 10000. * np.log10(years_since_publishing))
+    return _numeric(df['bggrating']) * 2 + lasting_popularity
+
+
+@register_score('best_for')
+def best_players(df):
+    n_players = _numeric(df['nplayers_best_min']).values
+    return pd.Series(np.select([n_players == 2, n_players == 3, n_players == 4, n_players >= 5],
+                               ['2 players', '3 players', '4 players', '5 or more players'],
+                               default=None), index=df.index)
+
+
+CLUSTER_FAMILIES = [('category-cluster', 'cat', ('cat-expansion for base-game', 'cat-fan expansion')),
+                    ('mechanics-cluster', 'mech', ())]
+FEATURE_COLUMNS = [c for c, _, _ in CLUSTER_FAMILIES] + list(SCORES)
+
+_worker_data = None
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _fit_attempt(n_clusters, seed):
+    km = KMeans(n_clusters=n_clusters, init='k-means++', max_iter=1000, n_init=1,
+                random_state=seed).fit(_worker_data)
+    clusters = km.predict(_worker_data)
+    return km, max(Counter(clusters).values())
+
+
+def search_clustering(data, n_clusters=5, imax=50000, cluster_max=140, n_jobs=None,
+                      random_state=None):
+    """Fit single-init KMeans models with different seeds until the biggest cluster has fewer
+    than cluster_max members, spread over a pool of n_jobs processes.
+
+    Attempt i always uses the i-th seed drawn from random_state, and the first acceptable
+    attempt in that order wins, so the result only depends on random_state. If no attempt
+    is acceptable, the one with the smallest biggest cluster is returned.
+    Returns the fitted KMeans model and whether it is acceptable.
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    seeds = np.random.RandomState(random_state).randint(np.iinfo(np.int32).max, size=imax)
+    suitable = {}
+    best = (np.inf, imax, None)
+    found = imax
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                             initargs=(data,)) as executor:
+        pending = {}
+        progress = tqdm(total=imax)
+        i = 0
+        while i < found or pending:
+            while i < found and len(pending) < 2 * n_jobs:
+                pending[executor.submit(_fit_attempt, n_clusters, seeds[i])] = i
+                i += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = pending.pop(future)
+                progress.update()
+                METRICS.count('kmeans_attempts_total')
+                km, biggest_cluster = future.result()
+                if biggest_cluster < cluster_max:
+                    suitable[idx] = km
+                    found = min(found, idx)
+                elif (biggest_cluster, idx) < best[:2]:
+                    best = (biggest_cluster, idx, km)
+            for future, idx in list(pending.items()):
+                if idx > found and future.cancel():
+                    del pending[future]
+        progress.close()
+    if found < imax:
+        return suitable[found], True
+    return best[2], False
+
 
 class FeatureGenerator:
-    def __init__(self, df):
+    def __init__(self, df, tag_matrix=None):
+        """tag_matrix is an optional callable like Database.tag_matrix, to get the category and
+        mechanics tags from when they aren't stored as cat-*/mech-* columns of df."""
         self.df = df
+        self.tag_matrix = tag_matrix
+        self.tag_matrices = {}
 
-    def do_clustering(self, n_clusters=5, biggest_cluster=999999, imax=50000, cluster_max=140):
-        cat_cols = [col for col in self.df.columns if 'cat-' in col and
-                    col != 'cat-expansion for base-game' and col != 'cat-fan expansion']
-        mech_cols = [col for col in self.df.columns if 'mech-' in col]
-        selection = (self.df['updated'] == 1) & (self.df['rank'] <= 1000)
-
-        for c, x in zip(['category-cluster', 'mechanics-cluster'], [cat_cols, mech_cols]):
-            data = np.array(self.df[selection][x].fillna(0))
-            print("\nKmeans Clustering\n")
-            for i in tqdm(range(imax)):
-                km = KMeans(n_clusters=n_clusters, init='k-means++', max_iter=1000, n_init=1)\
-                    .fit(data)
-                clusters = list(km.predict(data))
-                biggest_cluster = max([tupl[1] for tupl in Counter(clusters).items()])
-                if biggest_cluster < cluster_max:
-                    break
-            if biggest_cluster >= cluster_max:
-                print('No suitable cluster configuration found!')
-            print(Counter(clusters).items())
-
-            cluster_titles = []
-            for cl in range(0, n_clusters):
-                center = km.cluster_centers_[cl]
-                center = {x[idx]: int(np.round(cat * 100)) for idx, cat in enumerate(center)}
-                sorted_x = sorted(center.items(), key=operator.itemgetter(1), reverse=True)
-                for cat in sorted_x[:5]:
-                    print('* {} - {}'.format(re.sub(r'(cat-|mech-)', '', cat[0]), cat[1]))
-
-                cluster_titles.append(str(cl + 1) + ') ' + ' - '.join(
-                    [re.sub(r'(cat-|mech-)', '', cat[0]) for cat in sorted_x[:3]]))
-                indices = [i for i, clu in enumerate(clusters) if clu == cl]
-                df_cluster = self.df[selection].iloc[indices]
-                print(("\n{}" + '-' * 100 + '\n')
-                      .format(list(df_cluster[df_cluster['votes'] >= 10000]['title'])))
-
-            print(cluster_titles)
-            data_all = np.array(self.df[x].fillna(0))
-            clusters_all = list(km.predict(data_all))
-            print(len(self.df))
-            print(len([cluster_titles[ele] for ele in clusters_all]))
-            self.df[c] = [cluster_titles[ele] for ele in clusters_all]
+    def tag_data(self, kind, exclude=()):
+        """Return the sparse one-hot matrix of a kind of tags, with a row for every game in df,
+        and its column names. The matrix is built once and reused by later calls."""
+        if kind not in self.tag_matrices:
+            if self.tag_matrix is not None:
+                self.tag_matrices[kind] = self.tag_matrix(kind, list(self.df.index))
+            else:
+                self.tag_matrices[kind] = self.tag_columns_as_matrix(kind)
+        data, cols = self.tag_matrices[kind]
+        keep = [idx for idx, col in enumerate(cols) if col not in exclude]
+        return data[:, keep], [cols[idx] for idx in keep]
 
-    def add_final_score_best_players(self):
-        self.df['final_score'] = self.df.apply(self.final_score, axis=1)
-        self.df['best_for'] = self.df.apply(self.best_players, axis=1)
+    def tag_columns_as_matrix(self, kind):
+        cols = [col for col in self.df.columns if kind + '-' in col]
+        rows, col_idx = [], []
+        for idx, col in enumerate(cols):
+            nonzero = np.flatnonzero(self.df[col].fillna(0).values)
+            rows.append(nonzero)
+            col_idx.append(np.full(len(nonzero), idx))
+        rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+        col_idx = np.concatenate(col_idx) if col_idx else np.array([], dtype=int)
+        matrix = csr_matrix((np.ones(len(rows)), (rows, col_idx)), shape=(len(self.df), len(cols)))
+        return matrix, cols
 
     @staticmethod
-    def final_score(row):
-        years_since_publishing = date.today().year - row['year'] + 2
-        lasting_popularity = np.log10(
-            row['numplays_month'] + row['numplays'] / 10000. * np.log10(years_since_publishing))
-        final_score = row['bggrating'] * 2 + lasting_popularity
-        return final_score
+    def nearest_centroid(data, centers):
+        """Index of the nearest of centers for every row of the sparse matrix data"""
+        distances = -2 * np.asarray(data.dot(centers.T)) + (centers ** 2).sum(axis=1)
+        return np.argmin(distances, axis=1)
+
+    def clustering_selection(self):
+        """The games the clusters are fitted on: the top 1000 games whose details were scraped"""
+        updated = pd.to_datetime(self.df['updated'], errors='coerce')
+        return (updated > datetime(2000, 1, 1)) & (self.df['rank'] <= 1000)
+
+    def do_clustering(self, n_clusters=5, biggest_cluster=999999, imax=50000, cluster_max=140,
+                      n_jobs=None, random_state=None):
+        selection = self.clustering_selection()
+        return {c: self.fit_clusters(c, kind, exclude, selection, n_clusters=n_clusters, imax=imax,
+                                     cluster_max=cluster_max, n_jobs=n_jobs,
+                                     random_state=random_state)
+                for c, kind, exclude in CLUSTER_FAMILIES}
+
+    def fit_clusters(self, c, kind, exclude, selection, n_clusters=5, imax=50000, cluster_max=140,
+                     n_jobs=None, random_state=None):
+        """Fit the clusters of one kind of tags on the selection, assign them to all games and
+        return the fitted model: the tag columns, cluster centers and cluster titles."""
+        data_all, x = self.tag_data(kind, exclude)
+        data = data_all[np.flatnonzero(selection.values)]
+        print("\nKmeans Clustering\n")
+        with METRICS.timer('clustering_seconds', kind=kind):
+            km, suitable = search_clustering(data, n_clusters=n_clusters, imax=imax,
+                                             cluster_max=cluster_max, n_jobs=n_jobs,
+                                             random_state=random_state)
+        clusters = list(self.nearest_centroid(data, km.cluster_centers_))
+        if not suitable:
+            print('No suitable cluster configuration found!')
+        print(Counter(clusters).items())
+
+        cluster_titles = []
+        for cl in range(0, n_clusters):
+            center = km.cluster_centers_[cl]
+            center = {x[idx]: int(np.round(cat * 100)) for idx, cat in enumerate(center)}
+            sorted_x = sorted(center.items(), key=operator.itemgetter(1), reverse=True)
+            for cat in sorted_x[:5]:
+                print('* {} - {}'.format(re.sub(r'(cat-|mech-)', '', cat[0]), cat[1]))
+
+            cluster_titles.append(str(cl + 1) + ') ' + ' - '.join(
+                [re.sub(r'(cat-|mech-)', '', cat[0]) for cat in sorted_x[:3]]))
+            indices = [i for i, clu in enumerate(clusters) if clu == cl]
+            df_cluster = self.df[selection].iloc[indices]
+            print(("\n{}" + '-' * 100 + '\n')
+                  .format(list(df_cluster[df_cluster['votes'] >= 10000]['title'])))
+
+        print(cluster_titles)
+        model = {'fingerprint': self.fingerprint(x), 'columns': x,
+                 'centers': km.cluster_centers_, 'titles': cluster_titles,
+                 'selection': set(self.df.index[selection])}
+        self.assign_clusters(c, kind, exclude, model)
+        print(len(self.df))
+        return model
+
+    def assign_clusters(self, c, kind, exclude, model, rows=None):
+        """Assign the clusters of a fitted model to the games in rows, by default all games"""
+        data_all, _ = self.tag_data(kind, exclude)
+        if rows is None:
+            self.df[c] = np.array(model['titles'])[self.nearest_centroid(data_all,
+                                                                         model['centers'])]
+            return
+        positions = np.flatnonzero(np.asarray(rows))
+        if len(positions) > 0:
+            clusters = self.nearest_centroid(data_all[positions], model['centers'])
+            self.df.loc[self.df.index[positions], c] = np.array(model['titles'])[clusters]
 
     @staticmethod
-    def best_players(row):
-        if row['nplayers_best_min'] == 2:
-            return '2 players'
-        elif row['nplayers_best_min'] == 3:
-            return '3 players'
-        elif row['nplayers_best_min'] == 4:
-            return '4 players'
-        elif row['nplayers_best_min'] >= 5:
-            return '5 or more players'
+    def fingerprint(columns):
+        return hashlib.sha1('\n'.join(columns).encode('utf-8')).hexdigest()
+
+    def update_features(self, state_file='models/feature_state.pkl', max_selection_change=0.1,
+                        **clustering):
+        """Only compute the features of the games that changed since the last call.
+
+        The fitted clusters are kept in state_file. They are refitted, and assigned to all
+        games, when the tag vocabulary changed or when more than max_selection_change of the
+        top-1000 selection is different; otherwise they are only assigned to the games
+        updated since the last pass and the games that are new since then. The same goes
+        for the registered scores.
+        Returns the index of the games whose features were (re)computed.
+        """
+        started = datetime.now()
+        state = self.load_state(state_file)
+        if state is None or any(col not in self.df for col in FEATURE_COLUMNS):
+            changed = pd.Series(True, index=self.df.index)
+        else:
+            updated = pd.to_datetime(self.df['updated'], errors='coerce')
+            changed = (updated > state['last_pass']) | ~self.df.index.isin(state['gameids'])
+        models = state['clusters'] if state is not None else {}
+        selection = self.clustering_selection()
+        selected = set(self.df.index[selection])
+        refitted = False
+        for c, kind, exclude in CLUSTER_FAMILIES:
+            _, x = self.tag_data(kind, exclude)
+            model = models.get(c)
+            if model is None or model['fingerprint'] != self.fingerprint(x) or \
+                    len(model['selection'] ^ selected) > \
+                    max_selection_change * len(model['selection'] | selected):
+                models[c] = self.fit_clusters(c, kind, exclude, selection, **clustering)
+                refitted = True
+            else:
+                self.assign_clusters(c, kind, exclude, model, changed)
+        if refitted:
+            changed[:] = True
+        for column, score in SCORES.items():
+            if changed.any():
+                with METRICS.timer('scoring_seconds', score=column):
+                    self.df.loc[changed, column] = score(self.df[changed])
+        self.save_state(state_file, {'last_pass': started, 'clusters': models,
+                                     'gameids': set(self.df.index)})
+        return self.df.index[changed]
+
+    @staticmethod
+    def load_state(state_file):
+        try:
+            with open(state_file, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    @staticmethod
+    def save_state(state_file, state):
+        with open(state_file + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(state_file + '.tmp', state_file)
+
+    def add_trend_features(self, history, days=(30, 365),
+                           fields=('usersrated', 'numplays', 'baverage')):
+        """Add the change of fields over the last days from a HistoryStore as columns like
+        usersrated_change_30d. Fields without history from before the period get NaN."""
+        now = datetime.now()
+        for window in days:
+            changes = history.changes(now - timedelta(days=window))
+            for field in fields:
+                self.df['{}_change_{}d'.format(field, window)] = \
+                    changes[field].reindex(self.df.index).values
+
+    def add_final_score_best_players(self):
+        self.add_scores(['final_score', 'best_for'])
+
+    def add_scores(self, columns=None):
+        """Add the columns of the registered scoring functions, by default all of them"""
+        for column in columns if columns is not None else SCORES:
+            with METRICS.timer('scoring_seconds', score=column):
+                self.df[column] = SCORES[column](self.df)
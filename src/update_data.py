@@ -1,20 +1,196 @@
+import hashlib
+import inspect
+import json
+import os
+from datetime import date, datetime
+
+import click
+
 from src.data.scrape_data import BGGInterface
-from src.features.build_features import FeatureGenerator
-from src.visualization.visualize import CandidateViewer
+from src.features import build_features
+from src.features.build_features import FeatureGenerator, FEATURE_COLUMNS
+from src.visualization import visualize
+from src.visualization.visualize import CandidateIndex, CandidateViewer
 from src.data.database import Database
+from src.data.cache import ResponseCache
+from src.data.metrics import METRICS
+
+
+class Pipeline:
+    """The stages of updating the games, each of which records the fingerprint of its inputs
+    and its output artifacts in state_file when it finishes. A stage is skipped when its
+    inputs have the fingerprint of its last run and its artifacts still exist."""
+
+    def __init__(self, database='data/processed/bgg.db', state_file='data/processed/pipeline.json',
+                 feature_state='models/feature_state.pkl',
+                 candidate_index='models/candidate_index.pkl', force=False):
+        self.database = database
+        self.state_file = state_file
+        self.feature_state = feature_state
+        self.candidate_index = candidate_index
+        self.force = force
+        self._db = None
+        self._bgg = None
+        try:
+            with open(state_file) as f:
+                self.state = json.load(f)
+        except (IOError, ValueError):
+            self.state = {}
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = Database(self.database, tag_storage='table')
+        return self._db
+
+    @property
+    def bgg(self):
+        if self._bgg is None:
+            self._bgg = BGGInterface(self.db, cache=ResponseCache())
+        return self._bgg
+
+    @staticmethod
+    def fingerprint(inputs):
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def file_fingerprint(filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def source_fingerprint(module):
+        return hashlib.sha1(inspect.getsource(module).encode('utf-8')).hexdigest()
+
+    def is_current(self, stage, inputs):
+        record = self.state.get(stage)
+        return not self.force and record is not None and \
+            record['fingerprint'] == self.fingerprint(inputs) and \
+            all(os.path.exists(artifact) for artifact in record['artifacts'])
+
+    def run(self, stage, inputs, artifacts, func):
+        """Run func unless the stage is current; the inputs are computed again after func, for
+        stages that change their own inputs. Returns whether func was run."""
+        if self.is_current(stage, inputs()):
+            print('{}: inputs unchanged, skipping'.format(stage))
+            METRICS.count('stages_skipped_total', stage=stage)
+            return False
+        with METRICS.timer('stage_seconds', stage=stage):
+            func()
+        self.state[stage] = {'fingerprint': self.fingerprint(inputs()), 'artifacts': artifacts,
+                             'finished': datetime.now().isoformat()}
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(self.state_file + '.tmp', self.state_file)
+        return True
+
+    def discover(self, recrawl_after=7, workers=1):
+        def inputs():
+            # the publishers are crawled again at most every recrawl_after days anyway
+            return {'recrawl_after': recrawl_after,
+                    'period': date.today().toordinal() // recrawl_after}
+
+        self.run('discover', inputs, [self.database],
+                 lambda: self.bgg.add_new_games(recrawl_after, workers=workers))
+
+    def refresh(self, freshness=60, workers=1, parse_workers=0):
+        def inputs():
+            return {'freshness': freshness, 'day': date.today().isoformat(),
+                    'database': Database.fingerprint(self.database)}
+
+        self.run('refresh', inputs, [self.database],
+                 lambda: self.bgg.update_all_game_details(freshness, workers=workers,
+                                                          parse_workers=parse_workers))
+
+    def features(self):
+        def inputs():
+            return {'database': Database.fingerprint(self.database),
+                    'code': self.source_fingerprint(build_features)}
+
+        self.run('features', inputs, [self.database, self.feature_state], self.compute_features)
+
+    def compute_features(self):
+        feature_generator = FeatureGenerator(self.db.df, tag_matrix=self.db.tag_matrix)
+        changed = feature_generator.update_features(self.feature_state)
+        self.db.set_columns(feature_generator.df.loc[changed], FEATURE_COLUMNS)
+        self.db.close(snapshot=True)
+
+    def report(self):
+        def inputs():
+            return {'database': Database.fingerprint(self.database),
+                    'features': self.file_fingerprint(self.feature_state),
+                    'code': self.source_fingerprint(visualize)}
+
+        candidates = []
+        self.run('report', inputs, [self.candidate_index],
+                 lambda: candidates.append(self.build_candidate_index()))
+        index = candidates[0] if candidates else CandidateIndex.load(self.candidate_index)
+        CandidateViewer(index=index).show_candidates()
+
+    def build_candidate_index(self):
+        index = CandidateIndex(self.db.df)
+        index.save(self.candidate_index)
+        return index
+
+
+@click.group(invoke_without_command=True)
+@click.option('--database', type=click.Path(), default='data/processed/bgg.db')
+@click.option('--state-file', type=click.Path(), default='data/processed/pipeline.json')
+@click.option('--force', is_flag=True, help='Run the stages even if their inputs are unchanged.')
+@click.option('--metrics-dir', type=click.Path(), default=None,
+              help='Write the metrics of the run to metrics.prom and metrics.json in this directory.')
+@click.pass_context
+def cli(ctx, database, state_file, force, metrics_dir):
+    """ Updates the games and their features in stages: discover new games, refresh the
+        details of stale games, compute the features and report the candidates.
+        Without a command all stages are run, skipping those whose inputs are unchanged.
+    """
+    ctx.obj = Pipeline(database, state_file, force=force)
+    if metrics_dir is not None:
+        METRICS.enable()
+        ctx.call_on_close(lambda: METRICS.write(metrics_dir))
+    if ctx.invoked_subcommand is None:
+        ctx.invoke(discover)
+        ctx.invoke(refresh)
+        ctx.invoke(features)
+        ctx.invoke(report)
+
+
+@cli.command()
+@click.option('--recrawl-after', default=7, help='Days before a publisher is crawled again.')
+@click.option('--workers', default=1)
+@click.pass_obj
+def discover(pipeline, recrawl_after, workers):
+    """ Adds the games listed for the publishers. """
+    pipeline.discover(recrawl_after, workers)
+
+
+@cli.command()
+@click.option('--freshness', default=60, help='Days after which the details of a game are stale.')
+@click.option('--workers', default=1)
+@click.option('--parse-workers', default=0, help='Processes parsing the pages fetched by the workers.')
+@click.pass_obj
+def refresh(pipeline, freshness, workers, parse_workers):
+    """ Scrapes the details of the stale games. """
+    pipeline.refresh(freshness, workers, parse_workers)
+
 
-db = Database()
+@cli.command()
+@click.pass_obj
+def features(pipeline):
+    """ Computes the clusters and scores of the changed games. """
+    pipeline.features()
 
-bgg = BGGInterface(db)
-bgg.add_new_games()
-bgg.update_all_game_details()
 
-feature_generator = FeatureGenerator(db.df)
-feature_generator.do_clustering()
-feature_generator.add_final_score_best_players()
+@cli.command()
+@click.pass_obj
+def report(pipeline):
+    """ Prints the candidates, from the saved candidate index if nothing changed. """
+    pipeline.report()
 
-bgg.df = feature_generator.df
-bgg.save_data()
 
-viewer = CandidateViewer(db.df)
-viewer.show_candidates()
+if __name__ == '__main__':
+    cli()
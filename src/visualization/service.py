@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+from datetime import datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import click
+import numpy as np
+
+from src.data.database import Database, DATE_FORMAT
+from src.visualization.visualize import CandidateIndex, COLUMNS
+
+
+class BadQueryError(ValueError):
+    pass
+
+
+class GameService:
+    """Answers game and candidate queries from a games database loaded once.
+
+    The games are kept as JSON-ready dicts and the candidates in a CandidateIndex, and the
+    encoded responses of the last cache_size distinct queries are cached. Nothing is ever
+    written, so a service can be shared by the threads of a ThreadingHTTPServer.
+    """
+    def __init__(self, filename='data/processed/bgg.db', tag_storage='table', cache_size=1024):
+        # without the snapshot and history the database files are only read
+        db = Database(filename, tag_storage=tag_storage, snapshot_file=None, history_file=None)
+        self.games = {}
+        for gameid in db.games:
+            game = {key: self.jsonable(value) for key, value in db.get_game(gameid).items()
+                    if not Database.is_tag_column(key)}
+            game['categories'] = db.get_tags(gameid, 'cat')
+            game['mechanics'] = db.get_tags(gameid, 'mech')
+            self.games[gameid] = game
+        has_features = db.games and all(c in db.df for c in COLUMNS)
+        self.index = CandidateIndex(db.df) if has_features else None
+        self.respond = lru_cache(maxsize=cache_size)(self._respond)
+
+    @staticmethod
+    def jsonable(value):
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, float) and math.isnan(value):
+            return None
+        if isinstance(value, datetime):
+            return value.strftime(DATE_FORMAT)
+        return value
+
+    def query(self, path, params):
+        """Return the status and JSON body for a path and its (name, value) query parameters"""
+        return self.respond(path.rstrip('/'), tuple(sorted(params)))
+
+    def _respond(self, path, params):
+        try:
+            if path.startswith('/games/'):
+                body = self.game(path[len('/games/'):])
+            elif path == '/candidates':
+                body = self.candidates(params)
+            elif path == '/top':
+                body = self.candidates([p for p in params if p[0] in ('n', 'top')])
+            else:
+                return 404, self.encode({'error': 'unknown path {}'.format(path)})
+        except KeyError as e:
+            return 404, self.encode({'error': 'unknown game {}'.format(e.args[0])})
+        except BadQueryError as e:
+            return 400, self.encode({'error': str(e)})
+        return 200, self.encode(body)
+
+    @staticmethod
+    def encode(body):
+        return json.dumps(body).encode('utf-8')
+
+    def game(self, gameid):
+        try:
+            return self.games[int(gameid)]
+        except ValueError:
+            raise BadQueryError('gameid {} is not a number'.format(gameid))
+
+    def candidates(self, params):
+        """The best scoring games passing the filters in params, see CandidateIndex.positions.
+
+        Ranges are given as low,high with either end optional, e.g. weight=1.5,2.5 or
+        year=2000, and best_for and the clusters can be repeated to allow several values.
+        """
+        filters, top_k = {}, 10
+        for name, value in params:
+            name = name.replace('-', '_')
+            if name in ('n', 'top'):
+                top_k = self.number(name, value, int)
+            elif name in ('weight', 'year'):
+                low, _, high = value.partition(',')
+                filters[name] = (self.number(name, low, float) if low else None,
+                                 self.number(name, high, float) if high else None)
+            elif name == 'players':
+                filters[name] = self.number(name, value, int)
+            elif name in ('min_weight_votes', 'min_score'):
+                filters[name] = self.number(name, value, float)
+            elif name in ('best_for', 'category_cluster', 'mechanics_cluster'):
+                filters.setdefault(name, []).append(value)
+            else:
+                raise BadQueryError('unknown filter {}'.format(name))
+        if self.index is None:
+            return []
+        found = self.index.positions(top_k=top_k, **filters)
+        return [self.games[gameid] for gameid in self.index.gameids[found]]
+
+    @staticmethod
+    def number(name, value, kind):
+        try:
+            return kind(value)
+        except ValueError:
+            raise BadQueryError('{} should be a number, not {}'.format(name, value))
+
+
+class GameRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = [(name, value) for name, values in parse_qs(url.query).items()
+                  for value in values]
+        status, body = self.server.service.query(url.path, params)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(service, host='127.0.0.1', port=8080):
+    server = ThreadingHTTPServer((host, port), GameRequestHandler)
+    server.service = service
+    return server
+
+
+@click.command()
+@click.argument('database_filepath', type=click.Path(exists=True), default='data/processed/bgg.db')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8080)
+@click.option('--tag-storage', type=click.Choice(['columns', 'table']), default='table')
+def main(database_filepath, host, port, tag_storage):
+    """ Serves the games of the database as JSON on /games/<gameid>, /top?n=10 and
+        /candidates?best_for=2 players&weight=1.5,2.5&year=2000,&players=4&n=10
+    """
+    server = make_server(GameService(database_filepath, tag_storage=tag_storage), host, port)
+    print('Serving on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
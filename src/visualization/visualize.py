@@ -1,24 +1,126 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+
+
+BEST_PLAYERS_SELECTIONS = ['2 players', '3 players', '4 players', '5 or more players']
+WEIGHT_SELECTIONS = [(1, 1.4), (1.5, 1.9), (1.9, 2.5), (2.5, 3.1), (3.1, 4)]
+CANDIDATE_FILTERS = dict(year=(2000, None), min_weight_votes=10, min_score=15)
+
+COLUMNS = ['title', 'year', 'weight', 'best_for', 'final_score', 'category-cluster',
+           'mechanics-cluster', 'url']
+NUMERIC_COLUMNS = ['year', 'weight', 'weight_votes', 'final_score', 'minplayers', 'maxplayers']
+CATEGORICAL_COLUMNS = ['best_for', 'category-cluster', 'mechanics-cluster']
+
+
+class CandidateIndex:
+    """The games sorted by final_score and kept as plain numpy arrays, so that filtering them
+    is a few vectorized comparisons, plus the precomputed top games of every best_for and
+    weight range bucket that show_candidates prints."""
+
+    def __init__(self, df, top_k=10):
+        ranked = df[pd.to_numeric(df['final_score'], errors='coerce').notnull()]
+        ranked = ranked.sort_values('final_score', ascending=False, kind='mergesort')
+        self.gameids = ranked.index.values
+        self.rows = {c: ranked[c].values for c in COLUMNS}
+        self.numeric = {c: pd.to_numeric(ranked[c], errors='coerce').values.astype(float)
+                        if c in ranked else np.full(len(ranked), np.nan)
+                        for c in NUMERIC_COLUMNS}
+        self.codes, self.categories = {}, {}
+        for c in CATEGORICAL_COLUMNS:
+            codes, categories = pd.factorize(ranked[c])
+            self.codes[c] = codes
+            self.categories[c] = {value: code for code, value in enumerate(categories)}
+        self.top_k = top_k
+        self.buckets = {(n_players, weight_range):
+                        self.positions(best_for=n_players, weight=weight_range, top_k=top_k,
+                                       **CANDIDATE_FILTERS)
+                        for n_players in BEST_PLAYERS_SELECTIONS
+                        for weight_range in WEIGHT_SELECTIONS}
+
+    def save(self, filename='models/candidate_index.pkl'):
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filename='models/candidate_index.pkl'):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    def _between(self, mask, column, value_range):
+        low, high = value_range
+        values = self.numeric[column]
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return mask
+
+    def _one_of(self, mask, column, values):
+        if isinstance(values, str):
+            values = [values]
+        # a lookup table over the codes is cheaper than np.isin; code -1 (missing) hits the end
+        wanted = np.zeros(len(self.categories[column]) + 1, dtype=bool)
+        wanted[[self.categories[column][v] for v in values if v in self.categories[column]]] = True
+        mask &= wanted[self.codes[column]]
+        return mask
+
+    def positions(self, best_for=None, weight=None, year=None, players=None,
+                  category_cluster=None, mechanics_cluster=None, min_weight_votes=None,
+                  min_score=None, top_k=10):
+        """Positions of the top_k best scoring games passing all the given filters.
+
+        weight and year are (low, high) ranges, either end can be None. players is a number of
+        players the game supports. best_for and the clusters are a value or a list of values.
+        """
+        mask = np.ones(len(self.gameids), dtype=bool)
+        if weight is not None:
+            mask = self._between(mask, 'weight', weight)
+        if year is not None:
+            mask = self._between(mask, 'year', year)
+        if players is not None:
+            mask = self._between(mask, 'minplayers', (None, players))
+            mask = self._between(mask, 'maxplayers', (players, None))
+        if min_weight_votes is not None:
+            mask = self._between(mask, 'weight_votes', (min_weight_votes, None))
+        if min_score is not None:
+            mask = self._between(mask, 'final_score', (min_score, None))
+        for column, values in [('best_for', best_for), ('category-cluster', category_cluster),
+                               ('mechanics-cluster', mechanics_cluster)]:
+            if values is not None:
+                mask = self._one_of(mask, column, values)
+        return np.flatnonzero(mask)[:top_k]
+
+    def query(self, top_k=10, **filters):
+        """The top_k best scoring games passing the filters of positions, as a DataFrame"""
+        found = self.positions(top_k=top_k, **filters)
+        return self.frame(found)
+
+    def bucket(self, n_players, weight_range):
+        return self.frame(self.buckets[(n_players, weight_range)])
+
+    def frame(self, found):
+        return pd.DataFrame({c: self.rows[c][found] for c in COLUMNS},
+                            index=self.gameids[found])
+
+
 class CandidateViewer:
-    def __init__(self, df):
+    def __init__(self, df=None, index=None):
+        """Show the candidates from a CandidateIndex, which is built from df if not given"""
         self.df = df
+        self.index = index if index is not None else CandidateIndex(df)
 
     def show_candidates(self):
-        best_players_selections = ['2 players', '3 players', '4 players', '5 or more players']
-        weight_selections = [(1, 1.4), (1.5, 1.9), (1.9, 2.5), (2.5, 3.1), (3.1, 4)]
-
-        cols = ['title', 'year', 'weight', 'best_for', 'final_score', 'category-cluster',
-                'mechanics-cluster', 'url']
-
-        for n_players in best_players_selections:
-            for weight_range in weight_selections:
-                selection = (self.df['best_for'] == n_players) & (self.df['weight'] >= weight_range[0]) & \
-                    (self.df['weight'] <= weight_range[1]) & (self.df['year'] >= 2000) & (self.df['weight_votes'] >= 10) & \
-                    (self.df['final_score'] >= 15)
+        for n_players in BEST_PLAYERS_SELECTIONS:
+            for weight_range in WEIGHT_SELECTIONS:
                 print('Weight: {} to {} - Best for {}'.format(weight_range[0], weight_range[1], n_players))
                 print('-'*80)
-                selected = self.df[selection][cols].sort_values('final_score', ascending=False).head(10)
-                for idx, row in selected.iterrows():
+                rows = self.index.rows
+                for pos in self.index.buckets[(n_players, weight_range)]:
                     print('{:<35} ({}) - {:.2f}, {}, {:.1f}, Cat: {}, Mech: {}\n\t\t{}'\
-                          .format(row['title'][:35], row['year'], row['weight'], row['best_for'], row['final_score'],
-                                  row['category-cluster'][0], row['mechanics-cluster'][0], row['url']))
+                          .format(rows['title'][pos][:35], rows['year'][pos], rows['weight'][pos],
+                                  rows['best_for'][pos], rows['final_score'][pos],
+                                  rows['category-cluster'][pos][0], rows['mechanics-cluster'][pos][0],
+                                  rows['url'][pos]))
                 print('\n\n')